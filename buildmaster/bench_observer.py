@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2014 Citrix Systems, Inc.
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Measure how many lines of a recorded do_build.sh log per second
+XcLogLineObserver from buildbot2.cfg handles, against the four regex
+matcher it replaced. Run it from the buildmaster directory with the
+python that runs the master, since it loads the configuration."""
+
+from optparse import OptionParser
+from re import compile
+from time import time
+from twisted.python import log
+
+def load_config(filename):
+    """Return the namespace of the buildbot configuration filename"""
+    namespace = {'__file__': filename}
+    execfile(filename, namespace)
+    return namespace
+
+class BuildStatus:
+    """Just enough of a buildbot BuildStatus for the observer"""
+    def __init__(self):
+        self.started = time()
+    def getTimes(self):
+        return self.started, None
+
+class StepStatus:
+    """Just enough of a buildbot BuildStepStatus for the observer"""
+    def __init__(self):
+        self.statistics = {}
+        self.texts = 0
+        self.build = BuildStatus()
+    def getBuild(self):
+        return self.build
+    def setStatistic(self, name, value):
+        self.statistics[name] = value
+    def setText(self, text):
+        self.texts += 1
+
+def make_step(config):
+    """Return a stand in for an XcBBShellCommand step"""
+    class Step:
+        name = 'do_build'
+        def __init__(self):
+            self.step_status = StepStatus()
+        def getText(self, cmd, results):
+            return config['XcBBShellCommand'].getText.im_func(self, cmd, results)
+    return Step()
+
+def make_legacy_observer(config):
+    """Return the observer class as it was before lines were classified
+    by a single regex"""
+    class LegacyObserver(config['XcLogLineObserver']):
+        task_re = compile(r'''^\[(?P<time>\d+:\d+:\d+\.\d+)\]: NOTE: Running task (?P<bb_current_task>\d+) of (?P<bb_task_number>\d+) \(ID: \d+, (?P<bbname>.*), (?P<taskstep>.*)\)$''')
+        start_re = compile(r"^STARTING STEP (.*)$")
+        oe_re = compile(r"^STARTING OE BUILD (.*)$")
+        problem_re = compile(r'^\[\d+:\d+:\d+\.\d+\]: (WARNING:|ERROR:)')
+        def outLineReceived(self, line):
+            smatch = self.start_re.match(line)
+            dirty = False
+            status = self.buildstep.step_status
+            if smatch:
+                status.setStatistic('do_build_step', smatch.group(1))
+                if 'oe_build' in status.statistics:
+                    del status.statistics['oe_build']
+                dirty = True
+            tmatch = self.task_re.match(line)
+            if tmatch:
+                values = tmatch.groupdict()
+                bb_current_task = int(values['bb_current_task'])
+                bb_task_number = int(values['bb_task_number'])
+                status.setStatistic('bb_current_task', bb_current_task)
+                status.setStatistic('bb_task_number', bb_task_number)
+                dirty = True
+            omatch = self.oe_re.match(line)
+            if omatch:
+                status.setStatistic('oe_build', omatch.group(1))
+                for k in ['bb_current_task', 'bb_task_number']:
+                    if k in status.statistics:
+                        del status.statistics[k]
+                dirty = True
+            pmatch = self.problem_re.match(line)
+            if pmatch:
+                if pmatch.group(1) == 'WARNING:':
+                    self.warnings += 1
+                    status.setStatistic('warnings', self.warnings)
+                elif pmatch.group(1) == 'ERROR:':
+                    self.errors += 1
+                    status.setStatistic('errors', self.errors)
+                    if status.statistics.get('firstError', '') == '':
+                        status.setStatistic('firstError', line)
+                else:
+                    log.msg('unexpected match %r' % pmatch.group(1))
+                dirty = True
+            if dirty:
+                status.setText(self.buildstep.getText(None, None))
+    return LegacyObserver
+
+def measure(observer_class, config, lines, repeat):
+    """Feed lines to a new observer_class repeat times, returning the
+    best lines per second and the step status of the last run"""
+    best = None
+    for _ in range(repeat):
+        step = make_step(config)
+        observer = observer_class(step)
+        t0 = time()
+        for line in lines:
+            observer.outLineReceived(line)
+        elapsed = time() - t0
+        observer.cancelText()
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(lines) / max(best, 1e-9), step.step_status
+
+def main():
+    parser = OptionParser(usage='usage: %prog [options] LOGFILE')
+    parser.add_option('-c', '--config', default='buildbot2.cfg', metavar='FILE',
+                      help='load XcLogLineObserver from FILE')
+    parser.add_option('-n', '--repeat', type='int', default=3,
+                      help='report the best of N runs', metavar='N')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('a do_build.sh log is needed')
+    lines = [line.rstrip('\r\n') for line in open(args[0], 'r')]
+    config = load_config(options.config)
+    results = []
+    for des, observer_class in [('before', make_legacy_observer(config)),
+                                ('after', config['XcLogLineObserver'])]:
+        rate, status = measure(observer_class, config, lines, options.repeat)
+        print '%-6s %10d lines/sec %8d status text updates' % (
+            des, rate, status.texts)
+        results.append((rate, status.statistics))
+    # the old matcher did not record progress marks
+    results[1][1].pop('progress_marks', None)
+    if results[0][1] != results[1][1]:
+        print 'WARNING: statistics differ', results[0][1], results[1][1]
+    print 'speedup %.1fx over %d lines' % (results[1][0] / results[0][0], 
+                                           len(lines))
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,7 @@
 #print "test"
 import re
 from twisted.python import log as logging
+from twisted.internet import defer
 from buildbot.steps.shell import ShellCommand
 #from twisted.python import components
 from buildbot.status.web import waterfall
@@ -31,16 +32,22 @@ class XcBBShellCommand(ShellCommand):
     problem_re = re.compile(r'^\[\d+:\d+:\d+\.\d+\]: (WARNING:|ERROR:|\|)')
     def __init__(self, *args, **kwargs):
         ShellCommand.__init__(self, *args, **kwargs)
+        self.problems = None # the 'bb problems' log, once there are any
         self.addLogObserver('stdio', XcLogLineObserver(self))
 
+    def addProblem(self, line):
+        """Copy line into the 'bb problems' log as it arrives, so that the
+        whole stdio log never needs reading back in"""
+        if self.problems is None:
+            self.problems = self.addLog('bb problems')
+        else:
+            line = "\n" + line
+        self.problems.addStdout(line)
+
     def createSummary(self, log):
         ShellCommand.createSummary(self, log)
-        problems = []
-        for line in log.getText().split("\n"):
-            if self.problem_re.match(line):
-                problems.append(line)
-        if problems:
-            self.addCompleteLog('bb problems', "\n".join(problems))
+        if self.problems is not None:
+            self.problems.finish()
 
 #    def describe(self, done=False):
 #        description = ShellCommand.describe(self, done)
@@ -59,6 +66,11 @@ class XcLogLineObserver(LogLineObserver):
         LogLineObserver.__init__(self)
         self.buildstep = buildstep
     def outLineReceived(self, line):
+        if not line.startswith('['):
+            return
+        if self.buildstep.problem_re.match(line):
+            self.buildstep.addProblem(line)
+            return
         match = self.task_re.match(line)
         if not match:
             return
@@ -94,33 +106,147 @@ class XcStepBox(waterfall.StepBox):
 from buildbot.status import base
 from zope.interface import implements
 from buildbot.status.builder import SUCCESS, WARNINGS, FAILURE, SKIPPED, EXCEPTION, RETRY 
-from twisted.internet import utils
-from twisted.internet.utils import getProcessValue
+from twisted.internet import reactor, protocol, error
+from time import time
+
+class NotifierProcess(protocol.ProcessProtocol):
+    """Fires deferred with the exit code of the command, or None if it
+    was killed by a signal, as soon as it exits even if something it
+    started still holds its output open"""
+    def __init__(self, deferred):
+        self.deferred = deferred
+    def processExited(self, reason):
+        self.deferred.callback(reason.value.exitCode)
 
 class XcShellBuildResultNoitifer(base.StatusReceiverMultiService):
-    compare_attrs = [ "builder_name", "command" ]
+    """Runs command with the result of each finished build of the builders
+    named by builder_name, which may be a name or a list of names.
+
+    Builds finishing within batch_delay seconds of each other share one
+    run of the command, with the worst of their results, and when several
+    builders are watched each builder=result follows as a further argument.
+    At most max_running commands run at once, each is killed after
+    timeout seconds, and failed runs are retried up to retries times,
+    waiting retry_delay seconds and doubling that each time. If max_queued
+    runs are waiting the oldest is dropped, so a slow command can never
+    pile up processes on the master. counters() reports what happened."""
+    compare_attrs = [ "builder_names", "command", "max_running", "timeout",
+                      "batch_delay", "retries", "retry_delay", "max_queued" ]
     result_dict = { SUCCESS: "SUCCESS", WARNINGS: "WARNINGS", FAILURE: "FAILURE", 
                     SKIPPED: "SKIPPED", EXCEPTION: "EXCEPTION", RETRY:"RETRY" }
-    def __init__(self, builder_name, command):
-        self.builder_name = builder_name
+    # how bad each result is, for picking the worst of a batch
+    result_rank = { SKIPPED: 0, SUCCESS: 1, WARNINGS: 2, RETRY: 3, FAILURE: 4, EXCEPTION: 5 }
+    def __init__(self, builder_name, command, max_running=2, timeout=300, batch_delay=5,
+                 retries=3, retry_delay=30, max_queued=50):
+        if isinstance(builder_name, basestring):
+            builder_name = [builder_name]
+        self.builder_names = list(builder_name)
         self.command = command
+        self.max_running = max_running
+        self.timeout = timeout
+        self.batch_delay = batch_delay
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_queued = max_queued
         self.watched = []
+        self.batch = [] # [(builderName, results)] waiting for the burst to end
+        self.batch_call = None
+        self.batch_time = None # when the first build in the batch finished
+        self.queue = [] # [(argv, time its first build finished, attempt)]
+        self.running = 0
+        self.calls = [] # pending retries
+        self.stats = { 'finished': 0, 'started': 0, 'succeeded': 0, 'failed': 0, 
+                       'timed_out': 0, 'retried': 0, 'dropped': 0, 
+                       'last_latency': None, 'max_latency': 0 }
         base.StatusReceiverMultiService.__init__(self)
 
-    def exec_command(self, command):
-        def print_result(val):
-            logging.msg("%s: Command %s exited with value of %d" % (str(self), str(command), val))
-        cmd = command[0]
-        ret = getProcessValue(cmd, command[1:]);
-        ret.addCallback(print_result)
-        
+    def counters(self):
+        """Return the queue depth, running commands, the outcomes so far
+        and the seconds from a build finishing to its command ending"""
+        counters = dict(self.stats)
+        counters['queued'] = len(self.queue)
+        counters['batched'] = len(self.batch)
+        counters['running'] = self.running
+        return counters
+
     def buildFinished(self, builderName, build, results):
-        if builderName != self.builder_name:
+        if builderName not in self.builder_names:
             logging.msg("%s: Invoked with builder I don't know about" % str(self))
             return # 
         result_text = self.translate_result(results)
-        logging.msg("%s: build finished with %s result" % (str(self), result_text))
-        self.exec_command([self.command, result_text])
+        logging.msg("%s: %s build finished with %s result" % (str(self), builderName, result_text))
+        self.stats['finished'] += 1
+        if not self.batch:
+            self.batch_time = time()
+        self.batch.append((builderName, results))
+        if self.batch_call is None:
+            self.batch_call = reactor.callLater(self.batch_delay, self.end_batch)
+
+    def end_batch(self):
+        """Queue one run of the command for the builds in the batch"""
+        self.batch_call = None
+        batch, self.batch = self.batch, []
+        worst = max([results for _, results in batch], key=lambda r: self.result_rank.get(r, 5))
+        argv = [self.command, self.translate_result(worst)]
+        if len(self.builder_names) > 1:
+            argv += ['%s=%s' % (name, self.translate_result(results)) for name, results in batch]
+        self.enqueue(argv, self.batch_time, 1)
+
+    def enqueue(self, argv, finished, attempt):
+        if len(self.queue) >= self.max_queued:
+            dropped = self.queue.pop(0)
+            self.stats['dropped'] += 1
+            logging.msg("%s: Queue full, dropping command %s" % (str(self), str(dropped[0])))
+        self.queue.append((argv, finished, attempt))
+        self.run_queue()
+
+    def run_queue(self):
+        while self.queue and self.running < self.max_running:
+            self.exec_command(*self.queue.pop(0))
+
+    def exec_command(self, command, finished, attempt):
+        d = defer.Deferred()
+        process = NotifierProcess(d)
+        self.running += 1
+        self.stats['started'] += 1
+        try:
+            reactor.spawnProcess(process, command[0], command, env={})
+        except Exception:
+            logging.err(None, "%s: unable to run %s" % (str(self), str(command)))
+            reactor.callLater(0, d.callback, None)
+        timer = reactor.callLater(self.timeout, self.kill, process, command)
+        def print_result(val):
+            self.running -= 1
+            if timer.active():
+                timer.cancel()
+            else:
+                self.stats['timed_out'] += 1
+            latency = time() - finished
+            self.stats['last_latency'] = latency
+            self.stats['max_latency'] = max(self.stats['max_latency'], latency)
+            if val == 0:
+                self.stats['succeeded'] += 1
+            else:
+                self.stats['failed'] += 1
+            logging.msg("%s: Command %s exited with value of %s after %.1fs, counters %r" % (
+                    str(self), str(command), val, latency, self.counters()))
+            if val != 0 and attempt <= self.retries:
+                self.stats['retried'] += 1
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                self.calls.append(reactor.callLater(delay, self.retry, command, finished, attempt + 1))
+            self.run_queue()
+        d.addCallback(print_result)
+
+    def retry(self, command, finished, attempt):
+        self.calls = [call for call in self.calls if call.active()]
+        self.enqueue(command, finished, attempt)
+
+    def kill(self, process, command):
+        logging.msg("%s: Command %s timed out after %ds" % (str(self), str(command), self.timeout))
+        try:
+            process.transport.signalProcess('KILL')
+        except (error.ProcessExitedAlready, AttributeError):
+            pass
 
     def setServiceParent(self, parent):
         """
@@ -134,7 +260,7 @@ class XcShellBuildResultNoitifer(base.StatusReceiverMultiService):
         self.master_status.subscribe(self)
 
     def builderAdded(self, name, builder):
-        if name != self.builder_name:
+        if name not in self.builder_names:
             return None # we don't care
         self.watched.append(builder)
         return self # subscribe to this builder
@@ -143,6 +269,9 @@ class XcShellBuildResultNoitifer(base.StatusReceiverMultiService):
         self.master_status.unsubscribe(self)
         for w in self.watched:
             w.unsubscribe(self)
+        for call in self.calls + [self.batch_call]:
+            if call is not None and call.active():
+                call.cancel()
         return base.StatusReceiverMultiService.disownServiceParent(self)
 
     def translate_result(self, result):
@@ -155,9 +284,55 @@ class Logwrap:
     def getText(self):
         return self.text
 
+class ProblemLog:
+    """Stands in for the 'bb problems' log, counting what is written"""
+    def __init__(self):
+        self.lines = 0
+        self.size = 0
+    def addStdout(self, text):
+        self.lines += 1
+        self.size += len(text)
+    def finish(self):
+        pass
+
+class StepStatus:
+    """Stands in for the step's status, keeping its statistics"""
+    def __init__(self):
+        self.statistics = {}
+    def setStatistic(self, name, value):
+        self.statistics[name] = value
+
 if __name__ == "__main__":
+    # benchmark picking the problems out of the do_build log in argv[1],
+    # fed through the step in chunks as the slave sends them, or with
+    # --legacy by reading the whole log back in as createSummary used to
     import sys
-    text = open(sys.argv[1]).read()
-    wrap = Logwrap(text)
+    from resource import getrusage, RUSAGE_SELF
+    legacy = '--legacy' in sys.argv[1:]
+    filename = [arg for arg in sys.argv[1:] if arg != '--legacy'][0]
     xc = XcBBShellCommand(name="CopyConfig", description="test", command=["echo" , "test"], haltOnFailure=True)
-    xc.createSummary(wrap)
+    problems = ProblemLog()
+    t0 = time()
+    if legacy:
+        lines = []
+        for line in open(filename).read().split("\n"):
+            if xc.problem_re.match(line):
+                lines.append(line)
+        if lines:
+            problems.addStdout("\n".join(lines))
+            problems.lines = len(lines)
+    else:
+        xc.addLog = lambda name: problems
+        xc.step_status = StepStatus()
+        observer = XcLogLineObserver(xc)
+        fin = open(filename)
+        while True:
+            chunk = fin.read(65536)
+            if not chunk:
+                break
+            observer.outReceived(chunk)
+        xc.createSummary(Logwrap(''))
+    elapsed = time() - t0
+    print "%s: %d problem lines (%d bytes) in %.2fs, max rss %dkB" % (
+        'legacy' if legacy else 'streaming', problems.lines, problems.size,
+        elapsed, getrusage(RUSAGE_SELF).ru_maxrss)
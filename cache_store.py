@@ -0,0 +1,188 @@
+#
+# Copyright (c) 2014 Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Files stored under their content hash, copied into place atomically
+and indexed by manifests which several machines may update at once.
+Shared by oe_cache_sync.py and sstate_cache.py"""
+
+from os import rename, unlink, link, chown, makedirs, fsync, getpid, lstat, utime
+from os.path import join, dirname, exists
+from errno import EEXIST, EXDEV, ENOENT
+from fcntl import flock, LOCK_EX, LOCK_SH, LOCK_UN
+from contextlib import contextmanager
+from hashlib import sha1
+from json import load, dump
+from socket import gethostname
+from time import time
+from sys import stdout
+
+BLOCK_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 60 # seconds, well inside buildbot's no output timeout
+
+class Progress:
+    """Counts the files and bytes a long job has handled, printing a
+    PROGRESS line every PROGRESS_INTERVAL seconds so that a build step
+    running it is not taken to have hung"""
+    def __init__(self, doing):
+        self.doing = doing
+        self.files = 0
+        self.size = 0
+        self.last = time()
+
+    def update(self, size=0):
+        """Count a file of size bytes"""
+        self.files += 1
+        self.size += size
+        if time() - self.last >= PROGRESS_INTERVAL:
+            self.last = time()
+            print 'PROGRESS: %s %d files (%.1f MB) so far' % (
+                self.doing, self.files, self.size / 1048576.0)
+            stdout.flush()
+
+def make_directories(path, uid=None):
+    """Make path and any missing parents, owned by uid if given"""
+    if not path or exists(path):
+        return
+    make_directories(dirname(path), uid)
+    try:
+        makedirs(path)
+    except OSError, exc:
+        if exc.errno != EEXIST:
+            raise
+        return
+    if uid is not None:
+        chown(path, uid, -1)
+
+def temporary_name(path):
+    """Return a name next to path which no other process will use"""
+    return '%s.tmp-%s-%d' % (path, gethostname(), getpid())
+
+def file_hash(path):
+    """Return the sha1 of the file at path"""
+    digest = sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+def copy_file(source, dest, uid=None):
+    """Copy source to dest through a temporary file renamed into place,
+    so that dest is either absent or complete, and return the sha1 of
+    what was copied. The copy is owned by uid if given and keeps the
+    modification time of source."""
+    make_directories(dirname(dest), uid)
+    temporary = temporary_name(dest)
+    digest = sha1()
+    fin = open(source, 'rb')
+    try:
+        fout = open(temporary, 'wb')
+        try:
+            while True:
+                block = fin.read(BLOCK_SIZE)
+                if not block:
+                    break
+                digest.update(block)
+                fout.write(block)
+            fout.flush()
+            fsync(fout.fileno())
+        finally:
+            fout.close()
+        st = lstat(source)
+        utime(temporary, (st.st_atime, st.st_mtime))
+        if uid is not None:
+            chown(temporary, uid, -1)
+        rename(temporary, dest)
+    except:
+        if exists(temporary):
+            unlink(temporary)
+        raise
+    finally:
+        fin.close()
+    return digest.hexdigest()
+
+def link_file(source, dest, uid=None):
+    """Hard link source at dest, replacing whatever is there, or copy it
+    if they are on different file systems"""
+    make_directories(dirname(dest), uid)
+    temporary = temporary_name(dest)
+    try:
+        link(source, temporary)
+    except OSError, exc:
+        if exc.errno != EXDEV:
+            raise
+        copy_file(source, dest, uid)
+        return
+    rename(temporary, dest)
+    # rename does nothing if dest was already a link to source
+    remove_file(temporary)
+
+def remove_file(path):
+    """Unlink path if it exists"""
+    try:
+        unlink(path)
+    except OSError, exc:
+        if exc.errno != ENOENT:
+            raise
+
+def object_path(store, digest):
+    """Return where the object with sha1 digest goes in store"""
+    return join(store, digest[:2], digest)
+
+@contextmanager
+def locked(path, exclusive=True):
+    """Hold a lock on the file at path, which is created if need be"""
+    make_directories(dirname(path))
+    f = open(path, 'a')
+    try:
+        flock(f.fileno(), LOCK_EX if exclusive else LOCK_SH)
+        yield f
+        flock(f.fileno(), LOCK_UN)
+    finally:
+        f.close()
+
+def read_manifest(path):
+    """Return the dictionary in the JSON manifest at path, or an empty
+    one if there is none"""
+    try:
+        f = open(path)
+    except IOError, exc:
+        if exc.errno != ENOENT:
+            raise
+        return {}
+    try:
+        return load(f)
+    finally:
+        f.close()
+
+def write_manifest(path, manifest):
+    """Replace the manifest at path, which readers see all at once"""
+    temporary = temporary_name(path)
+    f = open(temporary, 'w')
+    try:
+        dump(manifest, f, indent=0, sort_keys=True)
+        f.flush()
+        fsync(f.fileno())
+    finally:
+        f.close()
+    rename(temporary, path)
@@ -17,10 +17,13 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
 
-from sys import argv, stderr
+from sys import argv, stderr, exc_info
 from optparse import OptionParser
-from os import listdir
+from os import listdir, rename
 from json import dumps
+from subprocess import Popen
+from threading import Thread
+from tag_index import shared_index, list_tags_command
 
 try:
     from subprocess import check_output, PIPE, CalledProcessError
@@ -50,7 +53,7 @@ except ImportError:
 #Option parsing
 def read_options():
     """Read command line options"""
-    parser = OptionParser(usage="usage: %prog [options] TAG")
+    parser = OptionParser(usage="usage: %prog [options] TAG|NUMBER")
 
     parser.add_option('-r', '--repository-base', metavar='REPOBASE',
                       default='/home/xc_source/git/xenclient',
@@ -63,6 +66,10 @@ def read_options():
                       action='store')
     parser.add_option('-s', '--suffix', help='the suffix of build number',
                       action='store')
+    parser.add_option('--jobs', type='int', default=1, metavar='N',
+                      help='diff up to N repositories at once')
+    parser.add_option('-d', '--details', help='add committer date and changed '
+                      'file counts to the json records', action='store_true')
     global options
     options, args = parser.parse_args()
 
@@ -74,84 +81,212 @@ def read_options():
     global currentTag
     currentTag = args[0]
 
-#Collect command line options
-read_options()
-    
-data = []
+    #Check that the tag is the prefix, a build number, then the suffix
+    #'-' and the branch
+    if options.prefix is None or options.suffix is None:
+        parser.error('both --prefix and --suffix are needed')
+    if not options.suffix.startswith('-'):
+        parser.error('the suffix must be - and the branch')
+    #A bare build number, as do_tag prints, is the tag with that number
+    if currentTag.isdigit():
+        currentTag = options.prefix + currentTag + options.suffix
+    global currentNumber, currentBranch
+    number, _, currentBranch = currentTag[len(options.prefix):].partition('-')
+    if (not currentTag.startswith(options.prefix) or not number.isdigit() or
+        '-' + currentBranch != options.suffix):
+        parser.error(currentTag + ' is not ' + options.prefix + 'NUMBER' +
+                     options.suffix)
+    currentNumber = int(number)
 
-#Print out for info only
-if options.verbose:
-    print 'Finding previous tag to ' + currentTag
+#Fields read from each commit by log_entries, in format order. Every field
+#is preceded by a NUL, so the text following the last field up to the next
+#NUL (the --numstat lines, when asked for) is left over as an extra field.
+LOG_FIELDS = ['hash', 'parents', 'author', 'email', 'date', 'committer_date',
+              'message']
+LOG_FORMAT = ''.join(['%x00' + f for f in
+                      ['%H', '%p', '%an', '%ae', '%ad', '%ci', '%B']]) + '%x00'
 
-#Get the list of files & directories in repo base
-for item in listdir(options.repository_base):
-    #Be considerate: do not assume everything in the folder is a git repo...
-    if item.find('.git') == -1:
-        continue
+def split_stream(stream, separator='\0', size=65536):
+    """Yield the separator delimited fields of stream as they arrive"""
+    pending = ''
+    while True:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        fields = (pending + chunk).split(separator)
+        pending = fields.pop()
+        for field in fields:
+            yield field
+    yield pending
 
-    #Check if the argument tag exists and find the previous tag. Use 'git tag'
-    #as an efficient way to filter tags based on prefix and suffix, but check
-    #that what's between them is just a build number. Otherwise, searching for
-    #the suffix '-bar' would find tags for branch 'foo-bar' as well as 'bar'.
-    repod = options.repository_base + '/' + item
-    filter = options.prefix + '*' + options.suffix
-    foundCurrentTag = False
-    previousTag = None
+def log_entries(repod, grange, numstat=False):
+    """Yield a dictionary for each commit in grange of repod, all read
+    from a single git log"""
+    args = ['git', '--git-dir='+repod, 'log', '--pretty=format:'+LOG_FORMAT]
+    if numstat:
+        args.append('--numstat')
+    args.append(grange)
+    proc = Popen(args, stdout=PIPE)
+    fields = split_stream(proc.stdout)
+    #Skip what comes before the first NUL, which is always empty
+    fields.next()
+    entry = {}
+    for field in fields:
+        if len(entry) < len(LOG_FIELDS):
+            entry[LOG_FIELDS[len(entry)]] = field
+            continue
+        entry['files'] = entry['insertions'] = entry['deletions'] = 0
+        for line in field.splitlines():
+            stat = line.split('\t', 2)
+            if len(stat) != 3:
+                continue
+            entry['files'] += 1
+            #Binary files are counted as '-'
+            if stat[0].isdigit():
+                entry['insertions'] += int(stat[0])
+            if stat[1].isdigit():
+                entry['deletions'] += int(stat[1])
+        yield entry
+        entry = {}
+    proc.stdout.close()
+    if proc.wait():
+        raise CalledProcessError(proc.returncode, args)
+
+def subject(message):
+    """Return the subject of message as git's %s does"""
+    return ' '.join(message.strip('\n').split('\n\n', 1)[0].split('\n'))
+
+def format_entry(entry):
+    """Render entry as git log does by default"""
+    out = 'commit ' + entry['hash'] + '\n'
+    if ' ' in entry['parents']:
+        out += 'Merge: ' + entry['parents'] + '\n'
+    out += 'Author: ' + entry['author'] + ' <' + entry['email'] + '>\n'
+    out += 'Date:   ' + entry['date'] + '\n\n'
+    for line in entry['message'].rstrip('\n').split('\n'):
+        out += '    ' + line + '\n'
+    return out
 
-    for tag in check_output(['git', '--git-dir='+repod, 'tag', '-l', filter]).splitlines():
-        if tag == currentTag:
-            foundCurrentTag = True
+def diff_repository(item):
+    """Diff the current tag of repository item against its previous tag,
+    returning the lines to print and the json encoded records"""
+    output = []
+    records = []
 
-        if ('-' not in tag[len(options.prefix):-len(options.suffix)] and
-            tag < currentTag and
-            (previousTag is None or tag > previousTag)):
-            previousTag = tag
+    #Check if the argument tag exists and find the previous tag on the same
+    #branch. The tag index compares build numbers, not strings, and only
+    #takes the branch to be what follows the number, so that searching for
+    #the suffix '-bar' does not find tags for branch 'foo-bar' as well.
+    #Repositories carrying the same tags share one index.
+    repod = options.repository_base + '/' + item
+    index = shared_index(options.prefix,
+                         check_output(list_tags_command(repod, options.prefix)))
+    foundCurrentTag = currentTag in index.names
+    previousTag = None
+    previousNumber = index.previous_number(currentNumber, currentBranch)
+    if previousNumber is not None:
+        previousTag = index.tag(previousNumber, currentBranch)
 
     #Filter out repos that have no idea about the current tag
     if not foundCurrentTag:
         if options.verbose:
-            print 'Repo: ' + item + ': tag ' + currentTag + ' not found'
-        continue
+            output.append('Repo: ' + item + ': tag ' + currentTag + ' not found')
+        return output, records
 
     #Filter out repos where the current tag is the first
     if previousTag is None:
-        print 'Repo: ' + item + ' is new and is the first time it has been tagged.'
-        continue
+        output.append('Repo: ' + item + ' is new and is the first time it has been tagged.')
+        return output, records
 
     if options.verbose:
-        print 'Repo: ' + item + ': previous tag is ' + previousTag
+        output.append('Repo: ' + item + ': previous tag is ' + previousTag)
 
-    #Set up range string and get logs between the tags for the current repo
+    #Set up range string and read the logs between the tags for the current
+    #repo in one pass, which serves both the verbose and the json output
     grange = currentTag + '...' + previousTag
-    logOutput = check_output(['git', '--git-dir='+repod, 'log', grange])
+    entries = list(log_entries(repod, grange, options.details))
 
     #Check that there is some log output
-    if len(logOutput) == 0:
-        continue
+    if len(entries) == 0:
+        return output, records
 
     #If being verbose print out the output
     if options.verbose:
-        print item + ':'
-        print logOutput
-
-    #Get info from git log in line broken form and split to a list
-    lineBreakOutput = check_output(['git', '--git-dir='+repod, 'log', "--pretty=format:%H%n%an%n%s", grange]).splitlines()
-    linesPerEntry = 3 #Handy little var for code maintenence in the below loops
+        output.append(item + ':')
+        output.append('\n'.join([format_entry(entry) for entry in entries]))
 
     if not options.json_file:
-        continue
+        return output, records
+
+    for entry in entries:
+        record = {'hash': entry['hash'], 'author': entry['author'],
+                  'subject': subject(entry['message']),
+                  'repo': item}
+        if options.details:
+            for key in ['committer_date', 'files', 'insertions', 'deletions']:
+                record[key] = entry[key]
+        records.append(dumps(record))
+    return output, records
+
+def ordered_map(function, items, jobs):
+    """Yield function(item) for each of items in order, running it for
+    up to jobs items at once"""
+    def run(slot, item):
+        try:
+            slot.append(function(item))
+        except:
+            slot.append(exc_info())
+            slot.append(None)
+    window = []
+    items = iter(items)
+    while True:
+        while len(window) < max(jobs, 1):
+            try:
+                item = items.next()
+            except StopIteration:
+                break
+            slot = []
+            thread = Thread(target=run, args=(slot, item))
+            thread.start()
+            window.append((thread, slot))
+        if not window:
+            return
+        thread, slot = window.pop(0)
+        thread.join()
+        if len(slot) > 1:
+            raise slot[0][0], slot[0][1], slot[0][2]
+        yield slot[0]
+
+#Collect command line options
+read_options()
+
+#Print out for info only
+if options.verbose:
+    print 'Finding previous tag to ' + currentTag
+
+#Write the json records out as each repository is diffed, into a temporary
+#file so that a failure does not leave a truncated one in place
+if options.json_file:
+    fj = open(options.json_file + '.tmp', 'w')
+    fj.write('[')
+separator = ''
+
+#Get the list of files & directories in repo base. Be considerate: do not
+#assume everything in the folder is a git repo...
+items = sorted([item for item in listdir(options.repository_base)
+                if item.find('.git') != -1])
 
-    record = {}
-    for i, line in enumerate(lineBreakOutput):
-        record[ ['hash', 'author', 'subject'][i%linesPerEntry]] = line
-        if i%(linesPerEntry) == linesPerEntry-1:
-          record['repo'] = item
-          data.append(record)
-          record = {}
+for output, records in ordered_map(diff_repository, items, options.jobs):
+    for line in output:
+        print line
+    if options.json_file:
+        for record in records:
+            fj.write(separator + record)
+            separator = ', '
 
 if options.json_file:
     if options.verbose:
         print 'Writing output in json to', options.json_file
-    fj = open(options.json_file, 'w')
-    fj.write(dumps(data))
+    fj.write(']')
     fj.close()
+    rename(options.json_file + '.tmp', options.json_file)
@@ -18,20 +18,29 @@
 #
 
 from optparse import OptionParser
-from os import umask
-from json import loads, dump
-from sys import stderr, platform
+from os import umask, stat, rename, chown
+from os.path import isdir
+from tempfile import gettempdir
+from uuid import uuid4
+from json import loads, load, dump
+from sys import stderr, platform, exc_info
 from time import time
+from atexit import register
+from threading import Thread, Event, Lock
+from Queue import Queue
+from tag_index import TagIndex, list_tags_command, parse_tag_list, \
+    read_packed_tags, list_loose_tags
 
 GIT_TAG_PREFIX = 'tag: '
 GIT_BINARY = 'git'
 REPOSITORIES_LIST_NAME = 'repositories.txt'
 
+from subprocess import Popen
 try:
     from subprocess import check_output, PIPE, CalledProcessError
 except ImportError:
     # from https://gist.github.com/edufelipe/1027906
-    from subprocess import Popen, PIPE, CalledProcessError
+    from subprocess import PIPE, CalledProcessError
     def check_output(*popenargs, **kwargs):
         r"""Run command with arguments and return its output as a byte string.
 
@@ -68,11 +77,20 @@ def read_options():
                       metavar='SERVER', help='ssh to SERVER to run commands')
     parser.add_option('-u', '--user', default='git',
                       metavar='USER', help='ssh as USER')
+    parser.add_option('--ssh-command', default='ssh', metavar='COMMAND',
+                      help='Use COMMAND rather than ssh to reach SERVER')
     parser.add_option('-t', '--tag', action='store_true', help='create tag')
     parser.add_option('-v', '--verbose', help='produce debug output', 
                       action='store_true')
     parser.add_option('-f', '--force', help='create tag even if unnecessary',
                       action='store_true')
+    parser.add_option('--atomic', action='store_true',
+                      help='remove the new tag from every repository if tagging one fails')
+    parser.add_option('--state-file', metavar='FILE',
+                      help='Remember heads and tags in FILE and reuse them for '
+                      'repositories whose refs have not changed. Ignored with -s.')
+    parser.add_option('--invalidate-state', action='store_true',
+                      help='Ignore anything already in the --state-file')
     parser.add_option('--time-commands', help='show subprocess runtimes',
                       action='store_true')
     parser.add_option('-i', '--inspection-repository', metavar='REPO',
@@ -88,83 +106,426 @@ def read_options():
                       help='dump JSON record of repositories to FILE')
     parser.add_option('--git-binary', action='store', metavar='PATH',
                       default=GIT_BINARY, help='Use git binary at PATH')
+    parser.add_option('--jobs', type='int', default=1, metavar='N',
+                      help='Look at up to N repositories and N branches at once')
+    parser.add_option('--tag-index-file', metavar='FILE',
+                      help='Remember packed tags of the inspection repository in FILE '
+                      'so that only loose tags need listing next time. Ignored with -s.')
     options, args = parser.parse_args()
     GIT_BINARY = options.git_binary
     REPOSITORIES_LIST_NAME = options.repositories_base
 
-def command(args, **kw):
+def quote(args):
+    """Return args as a string for a POSIX shell"""
+    return " ".join("'" + x.replace("'", "'\"'\"'") + "'" for x in args)
+
+def ssh_command():
+    """Return the command to ssh to server. Sessions are multiplexed 
+    over one connection, which the first session sets up."""
+    return (options.ssh_command.split() + 
+            ['-o', 'ControlMaster=auto',
+             '-o', 'ControlPath='+gettempdir()+'/do_tag-ssh-%r@%h:%p',
+             options.user+'@'+options.server])
+
+def remote(args):
+    """Wrap args so that they run on server if we have one"""
+    if not options.server:
+        return args
+    return ssh_command() + [quote(args)]
+
+class RemoteShell:
+    """A shell on server reading commands from a single ssh session, so
+    that a command costs a write and a read rather than a new connection.
+    The output of each command is followed by a line holding a marker 
+    and the exit code."""
+    def __init__(self):
+        self.process = None
+        self.marker = 'do_tag-'+uuid4().hex
+        self.lock = Lock()
+
+    def script(self, args, input, errors=False):
+        """Return shell script to run args with input on standard input"""
+        line = quote(args)
+        if errors:
+            line = 'e=$(mktemp); ' + line + ' 2>"$e"'
+        if input is None:
+            script = line+' </dev/null\n'
+        else:
+            # a quoted here document is passed through verbatim
+            assert input == '' or input.endswith('\n'), input
+            script = "%s <<'%s'\n%s%s\n" % (line, self.marker, 
+                                             input, self.marker)
+        script += 'r=$?\n'
+        if errors:
+            script += 'if [ $r = 0 ]; then cat "$e" >&2; else cat "$e"; fi; rm -f "$e"\n'
+        return script + "printf '\\n%s %%d\\n' $r\n" % self.marker
+
+    def run_many(self, commands, errors=False):
+        """Run commands, a list of (args, input) pairs, and return a list
+        of (exit code, output) pairs. All the commands are sent before
+        any output is read, so they cost only one round trip."""
+        self.lock.acquire()
+        try:
+            if self.process is None:
+                self.process = Popen(ssh_command()+['sh'], stdin=PIPE, 
+                                     stdout=PIPE, bufsize=-1)
+            scripts = [self.script(args, input, errors) for args, input in commands]
+            # write from another thread so that we drain output while
+            # sending, otherwise both sides could block on full pipes
+            writer = Thread(target=self.send, args=(''.join(scripts),))
+            writer.start()
+            results = [self.receive() for _ in commands]
+            writer.join()
+            return results
+        finally:
+            self.lock.release()
+
+    def send(self, text):
+        """Write text to the remote shell"""
+        try:
+            self.process.stdin.write(text)
+            self.process.stdin.flush()
+        except IOError:
+            # the session has died, which receive reports
+            pass
+
+    def receive(self):
+        """Read the exit code and output of the next command"""
+        lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if line == '':
+                print >> stderr, 'ERROR: lost ssh session to', options.server
+                exit(8)
+            if line.startswith(self.marker+' '):
+                # the output gained a newline before the marker
+                return int(line.split()[1]), ''.join(lines)[:-1]
+            lines.append(line)
+
+    def close(self):
+        """End the ssh session"""
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+
+remote_shell = RemoteShell()
+register(remote_shell.close)
+
+def run_commands(commands, errors=False):
+    """Run commands, a list of (args, input) pairs, on server and return a
+    list of (exit code, output) pairs. Commands after a failure still run.
+    With errors, the output of a failed command is followed by its
+    standard error, so that the caller can report it."""
+    if options.server:
+        return remote_shell.run_many(commands, errors)
+    results = []
+    for args, input in commands:
+        process = Popen(args, stdin=None if input is None else PIPE,
+                        stdout=PIPE, stderr=PIPE if errors else None)
+        out, err = process.communicate(input)
+        if errors and process.returncode:
+            out += err
+        elif err:
+            stderr.write(err)
+        results.append((process.returncode, out))
+    return results
+
+def command_many(commands, errors=False):
+    """Run commands like run_commands, optionally reporting the time taken"""
+    t0 = time()
+    try:
+        return run_commands(commands, errors)
+    finally:
+        if options.time_commands:
+            print >>stderr, '%dms for %d commands starting %s' % (
+                (time()-t0)*1000, len(commands), ' '.join(commands[0][0]))
+
+def command(args, input=None):
     """Run command described by args on server"""
     t0 = time()
     try:
-        if options.server:
-            out = check_output(['ssh', options.user+'@'+options.server, 
-                                " ".join("'" + x.replace("'", "'\"'\"'") + "'" for x in args)], **kw)
+        if options.server or input is not None:
+            [(rc, out)] = run_commands([(args, input)])
+            if rc:
+                error = CalledProcessError(rc, args)
+                error.output = out
+                raise error
         else:
-            out = check_output(args, **kw)
+            out = check_output(args)
     finally:
         t1 = time()
         if options.time_commands:
             print >>stderr, '%dms for %s' % ((t1-t0)*1000, ' '.join(args))
     return out
 
-def get_repositories(branch):
-    """Return contents of repositories list on branch and its format"""
-    extns =['json', 'txt']
-    for extn in extns:
-        gdo = '--git-dir='+options.repository_base+'/'+options.inspection_repository+'.git'
-        tfile = branch+':'+REPOSITORIES_LIST_NAME.replace('.txt', '.'+extn)
+class RefResolver:
+    """Resolve revisions in one repository through a single long lived
+    git cat-file --batch-check process rather than a rev-parse per lookup"""
+    def __init__(self, repod):
+        self.repod = repod
+        self.process = None
+        self.known = {}
+        self.lookups = 0
+        self.elapsed = 0.0
+        self.lock = Lock()
+
+    def start(self):
+        """Launch the cat-file process"""
+        self.process = Popen(remote([GIT_BINARY, '--git-dir='+self.repod,
+                                     'cat-file', '--batch-check']),
+                             stdin=PIPE, stdout=PIPE, bufsize=-1)
+
+    def lookup(self, revision):
+        """Return the object name revision resolves to, or None"""
+        return self.lookup_many([revision])[0]
+
+    def lookup_many(self, revisions):
+        """Return a list of what each of revisions resolves to, or None.
+        Revisions are sent in batches without waiting for answers."""
+        self.lock.acquire()
         try:
-            return command([GIT_BINARY, gdo, 'show', tfile]), extn
-        except CalledProcessError:
-            if extn == extns[-1]:
-                raise
+            todo = [revision for revision in set(revisions) 
+                    if revision not in self.known]
+            for i in range(0, len(todo), 256):
+                # cat-file blocks once its output fills the pipe, so
+                # we should not get too far ahead of it
+                self.resolve(todo[i:i+256])
+            return [self.known[revision] for revision in revisions]
+        finally:
+            self.lock.release()
+
+    def resolve(self, revisions):
+        """Ask cat-file about revisions; the caller must hold self.lock"""
+        t0 = time()
+        try:
+            if self.process is None:
+                self.start()
+            try:
+                self.process.stdin.write(''.join(revision+'\n' for 
+                                                 revision in revisions))
+                self.process.stdin.flush()
+            except IOError:
+                pass
+            for revision in revisions:
+                try:
+                    line = self.process.stdout.readline()
+                except IOError:
+                    line = ''
+                if line == '':
+                    # cat-file went away, e.g. because repod is not a 
+                    # repository, in which case rev-parse would have failed too
+                    spl = ['', 'missing']
+                else:
+                    spl = line.split()
+                # cat-file answers "<name> missing" or "<name> ambiguous" on
+                # failure and "<sha> <type> <size>" on success
+                self.known[revision] = (None if spl[-1] in ['missing', 'ambiguous'] 
+                                        else spl[0])
+        finally:
+            self.lookups += len(revisions)
+            self.elapsed += time() - t0
+
+    def forget(self, revisions):
+        """Look revisions up afresh next time, as their refs may have moved"""
+        self.lock.acquire()
+        try:
+            for revision in revisions:
+                self.known.pop(revision, None)
+        finally:
+            self.lock.release()
+
+    def verify(self, revision):
+        """Resolve revision like rev-parse -q --verify would"""
+        result = self.lookup(revision)
+        if result is None:
+            raise CalledProcessError(1, 'rev-parse -q --verify '+revision)
+        return result
+
+    def close(self):
+        """Stop the cat-file process and optionally report its runtime"""
+        self.lock.acquire()
+        try:
+            if self.process is not None:
+                self.process.stdin.close()
+                self.process.wait()
+                self.process = None
+        finally:
+            self.lock.release()
+        if options.time_commands and self.lookups:
+            print >>stderr, '%dms for %d lookups by cat-file --batch-check on %s' % (
+                self.elapsed*1000, self.lookups, self.repod)
+        self.lookups = 0
+        self.elapsed = 0.0
+
+resolvers = {} # { repod : RefResolver }
+resolvers_lock = Lock()
+
+def get_resolver(repod):
+    """Return the RefResolver for repod, creating it if necessary"""
+    resolvers_lock.acquire()
+    try:
+        if repod not in resolvers:
+            resolvers[repod] = RefResolver(repod)
+        return resolvers[repod]
+    finally:
+        resolvers_lock.release()
+
+@register
+def close_resolvers():
+    """Shut down all cat-file processes"""
+    for repod in sorted(resolvers):
+        resolvers[repod].close()
 
 def get_head(branch, repod):
     """Get head on branch"""
-    return command([GIT_BINARY, '--git-dir='+ repod, 'rev-parse', '-q', '--verify', branch]).strip()
+    return get_resolver(repod).verify(branch)
+
+def file_stamp(path):
+    """Return something which changes when path is replaced, or None
+    if path does not exist"""
+    try:
+        st = stat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_size, st.st_mtime]
+
+def read_tag_index_file(repod):
+    """Return packed tag names for repod from options.tag_index_file,
+    or None if it does not have an up to date list"""
+    try:
+        cached = load(file(options.tag_index_file, 'r'))
+    except (IOError, ValueError):
+        return None
+    if (cached.get('repository') != repod or cached.get('prefix') != tag_prefix
+        or cached.get('packed_refs') != file_stamp(repod+'/packed-refs')):
+        return None
+    return cached['packed']
+
+def write_tag_index_file(repod, stamp, packed):
+    """Record packed tag names for repod in options.tag_index_file"""
+    tmp = options.tag_index_file+'.tmp'
+    try:
+        with open(tmp, 'w') as fout:
+            dump({'repository':repod, 'prefix':tag_prefix, 
+                  'packed_refs':stamp, 'packed':packed}, fout)
+        rename(tmp, options.tag_index_file)
+    except (IOError, OSError), exc:
+        print >> stderr, 'WARNING: unable to write', options.tag_index_file, exc
+
+def build_tag_index(repod):
+    """Make a TagIndex for repod with one for-each-ref, or with no
+    commands at all if options.tag_index_file is up to date for
+    the packed tags and only loose tags need to be listed"""
+    index = TagIndex(tag_prefix)
+    if options.server or not options.tag_index_file or not isdir(repod+'/refs/tags'):
+        out = command(list_tags_command(repod, tag_prefix, GIT_BINARY))
+        for name in parse_tag_list(out, tag_prefix):
+            index.add(name)
+        return index
+    t0 = time()
+    packed = read_tag_index_file(repod)
+    if packed is None:
+        stamp = file_stamp(repod+'/packed-refs')
+        packed = []
+        if stamp is not None:
+            packed = [name for name in read_packed_tags(repod) if 
+                      name.startswith(tag_prefix)]
+        write_tag_index_file(repod, stamp, packed)
+    for name in packed + list_loose_tags(repod):
+        index.add(name)
+    if options.time_commands:
+        print >>stderr, '%dms to index %d tags of %s' % (
+            (time()-t0)*1000, len(index.names), repod)
+    return index
+
+tag_indices = {} # { repod : TagIndex }
+tag_indices_lock = Lock()
+
+def get_tag_index(repod):
+    """Return the TagIndex for repod, building it if necessary"""
+    tag_indices_lock.acquire()
+    try:
+        if repod not in tag_indices:
+            tag_indices[repod] = build_tag_index(repod)
+        return tag_indices[repod]
+    finally:
+        tag_indices_lock.release()
 
 def find_highest_tag_number(repod, branch=None):
     """Work out next tag number on repod across all branches or
     a specific branch"""
-    postfix = ('-'+branch) if branch else ''
-    filter = tag_prefix+'*'+postfix
-    tags = command([GIT_BINARY, '--git-dir='+repod, 'tag', '-l', filter]).split()
-    itags = [] # the integer part of tags
-    for tag in tags:
-        try:
-            if branch:
-                num = int(tag[len(tag_prefix):-len(postfix)])
-            else:
-                num = int(tag[len(tag_prefix):].split('-')[0])
-        except ValueError:
-            continue
-        itags.append(num)
-    return sorted(itags)[-1] if itags else 100000
+    highest = get_tag_index(repod).highest_number(branch)
+    return 100000 if highest is None else highest
 
 def allocate_tag_number():
     """Work out next tag number"""
     return find_highest_tag_number(options.repository_base+'/'+
                                    options.inspection_repository+'.git')+1
 
-def set_tag(tag, repod, revision):
-    """apply tag to revision on repod"""
-    try:
-        command([GIT_BINARY, '--git-dir='+repod, 'tag', '-m', tag, tag, revision])
-    except CalledProcessError:
-        print >> stderr, 'ERROR: git tag failed'
+def fix_ownership(repod, tag, taghash):
+    """Give the tag ref and object we created to the owner of repod,
+    since we may be running as root"""
+    st = stat(repod)
+    # TODO: can we get git to tell us the object path to remove
+    # the nasty assumption of the layout of .git here?
+    for path in [repod+'/refs/tags/'+tag, repod+'/objects/'+taghash[:2], 
+                 repod+'/objects/'+taghash[:2]+'/'+taghash[2:]]:
+        try:
+            pst = stat(path)
+            if (pst.st_uid, pst.st_gid) != (st.st_uid, st.st_gid):
+                chown(path, st.st_uid, st.st_gid)
+        except OSError, exc:
+            print >> stderr, 'WARNING: unable to chown', path, exc
+
+def set_tags(tag, heads):
+    """Apply tag to each (repod, revision) in heads. All the tag objects are
+    made before any ref is written, so most failures leave nothing tagged.
+    With --atomic, refs already written are removed if writing one fails."""
+    if heads == []:
+        return
+    [(rc, tagger)] = command_many([([GIT_BINARY, '--git-dir='+heads[0][0], 'var',
+                                     'GIT_COMMITTER_IDENT'], None)], errors=True)
+    if rc:
+        print >> stderr, 'ERROR: git var GIT_COMMITTER_IDENT failed on', \
+            heads[0][0]+':', tagger.strip()
+        exit(3)
+    tagger = tagger.strip()
+    content = 'object %s\ntype commit\ntag %s\ntagger %s\n\n%s\n'
+    results = command_many([([GIT_BINARY, '--git-dir='+repod, 'mktag'], 
+                             content % (revision, tag, tagger, tag)) 
+                            for repod, revision in heads], errors=True)
+    for (repod, _), (rc, out) in zip(heads, results):
+        if rc:
+            print >> stderr, 'ERROR: git mktag failed on', repod+':', out.strip()
+            exit(3)
+    taghashes = [out.strip() for _, out in results]
+
+    # the all zero old value makes update-ref fail if the tag exists
+    results = command_many([([GIT_BINARY, '--git-dir='+repod, 'update-ref', 
+                              'refs/tags/'+tag, taghash, '0'*40], None)
+                            for (repod, _), taghash in zip(heads, taghashes)],
+                           errors=True)
+    failed = [(repod, out) for (repod, _), (rc, out) in zip(heads, results) if rc]
+    if failed:
+        for repod, out in failed:
+            print >> stderr, 'ERROR: git update-ref failed on', repod+':', out.strip()
+        if options.atomic:
+            written = [([GIT_BINARY, '--git-dir='+repod, 'update-ref', '-d', 
+                         'refs/tags/'+tag, taghash], None)
+                       for (repod, _), taghash, (rc, _) in 
+                       zip(heads, taghashes, results) if rc == 0]
+            if written:
+                print >> stderr, 'removing', tag, 'from', len(written), 'repositories'
+                for (args, _), (rc, _) in zip(written, command_many(written)):
+                    if rc:
+                        print >> stderr, 'ERROR: unable to remove', tag, \
+                            'with', ' '.join(args)
         exit(3)
 
     if not options.server and platform != 'win32':
-        tag_file = repod+'/refs/tags/'+tag
-        check_output(['chown', '--reference='+repod, tag_file])
-        # chown the object we just created
-        # TODO: can we get git to tell us the object path to remove
-        # the nasty assumption of the layout of .git here?
-        taghash = file(tag_file, 'r').read().strip()
-        check_output(['chown', '--reference='+repod,
-                      repod+'/objects/'+taghash[:2]])
-        check_output(['chown', '--reference='+repod,
-                      repod+'/objects/'+taghash[:2]+'/'+taghash[2:]])
+        for (repod, _), taghash in zip(heads, taghashes):
+            fix_ownership(repod, tag, taghash)
 
 def parse_lines(text):
     """Split into lines, strip out comments and trailing/leading white space,
@@ -179,15 +540,12 @@ def parse_lines(text):
         content.append(text)
     return content
 
-def parse_repositories(text, format, context):
-    """Parse a repositories.txt file or exit. Context is for error messages."""
+def read_repositories(text, format):
+    """Parse a repositories.txt file, returning None if it is unusable"""
     if format == 'txt':
         content = parse_lines(text)
         if len(content) < 2:
-            print >> stderr, 'ERROR: not enough in repositories.txt', context,
-            print >> stderr, 'need at least',
-            print >> stderr, 'a default branch and a single repository'
-            exit(1)
+            return None
 
         work = [options.inspection_repository] + [x for x in content[1:] if 
                                     x.split()[0] != options.inspection_repository]
@@ -196,27 +554,69 @@ def parse_repositories(text, format, context):
     assert format == 'json'
     return loads(text)
 
-def get_repolist(branch):
-    """Return default branch and a list of repositories for branch or exit"""
+def check_repositories(record, context):
+    """Return record from read_repositories, or exit if it was unusable.
+    Context is for error messages."""
+    if record is None:
+        print >> stderr, 'ERROR: not enough in repositories.txt', context,
+        print >> stderr, 'need at least',
+        print >> stderr, 'a default branch and a single repository'
+        exit(1)
+    return record
+
+def manifest_paths(branch):
+    """Return the paths of the possible repositories lists on branch,
+    and their formats, in order of preference"""
+    return [(branch+':'+REPOSITORIES_LIST_NAME.replace('.txt', '.'+extn), extn)
+            for extn in ['json', 'txt']]
+
+def prefetch_repolists(branches):
+    """Look up the repositories lists for all of branches in one go"""
+    paths = []
+    for branch in branches + ['master']:
+        paths += [path for path, _ in manifest_paths(branch)]
+    get_resolver(options.repository_base+'/'+options.inspection_repository+
+                 '.git').lookup_many(paths)
+
+manifests = {} # { (blob, format) : parsed repositories list or None }
+manifests_lock = Lock()
+
+def read_manifest(blob, format):
+    """Return the parsed repositories list in blob, reading each 
+    distinct blob only once"""
+    manifests_lock.acquire()
     try:
-        repos, extn = get_repositories(branch)
-    except CalledProcessError:
-        repos, extn  = get_repositories('master')
-    return parse_repositories(repos, extn, 'on '+branch)
+        if (blob, format) not in manifests:
+            text = command([GIT_BINARY, '--git-dir='+options.repository_base+'/'+
+                            options.inspection_repository+'.git', 
+                            'cat-file', 'blob', blob])
+            manifests[(blob, format)] = read_repositories(text, format)
+        return manifests[(blob, format)]
+    finally:
+        manifests_lock.release()
 
+def fetch_repolist(branch):
+    """Return the blob and format of the repositories list for branch, 
+    or master if branch has none"""
+    resolver = get_resolver(options.repository_base+'/'+
+                            options.inspection_repository+'.git')
+    for candidate in [branch, 'master']:
+        for path, extn in manifest_paths(candidate):
+            blob = resolver.lookup(path)
+            if blob is not None:
+                return blob, extn
+    raise CalledProcessError(128, 'git show '+path)
 
-def obtain_head(repod, branch, defbranch):
+def find_head(repod, branch, defbranch):
     """Work out the head of branch in repod. 
-    If the branch does not exist try defbranch."""
-    try:
-        return 'target '+branch, get_head(branch, repod)
-    except CalledProcessError:
-        pass
-    try:
-        return 'fallback '+defbranch, get_head(defbranch, repod)
-    except CalledProcessError:
-        print >> stderr, repod, 'has neither', branch, 'nor', defbranch
-        exit(6)
+    If the branch does not exist try defbranch. Return None, None if
+    neither exists."""
+    for des, candidate in [('target', branch), ('fallback', defbranch)]:
+        try:
+            return des+' '+candidate, get_head(candidate, repod)
+        except CalledProcessError:
+            pass
+    return None, None
 
 def get_latest_tag(branch, tag_format):
     """Find the latest tag on branch"""
@@ -224,17 +624,243 @@ def get_latest_tag(branch, tag_format):
     highest = find_highest_tag_number(repod, branch)
     return tag_format % (tag_prefix, highest, branch)
 
-def handle_branch(branch, tag_format):
-    """Work on branch"""
+class Task:
+    """A function call queued on a WorkerPool"""
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.cancelled = False
+        self.done = Event()
+        self.result = self.error = None
+
+    def run(self):
+        """Call the function unless we have been cancelled"""
+        if not self.cancelled:
+            try:
+                self.result = self.function(*self.args)
+            except:
+                # includes SystemExit, which is reraised by wait
+                self.error = exc_info()
+        self.done.set()
+
+    def wait(self):
+        """Return the result of the call, or raise what it raised"""
+        self.done.wait()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+class WorkerPool:
+    """A fixed number of threads running Tasks in the order submitted"""
+    def __init__(self, jobs):
+        self.queue = Queue()
+        self.stopping = False
+        self.threads = []
+        for _ in range(jobs):
+            thread = Thread(target=self.work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+        register(self.shutdown)
+
+    def work(self):
+        """Run tasks until shutdown"""
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            if self.stopping:
+                task.cancelled = True
+            task.run()
+
+    def shutdown(self):
+        """Abandon queued tasks and wait for running ones, so that no thread
+        is still working while the interpreter exits"""
+        self.stopping = True
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def submit(self, function, *args):
+        """Queue function(*args) and return its Task"""
+        task = Task(function, args)
+        self.queue.put(task)
+        return task
+
+branch_pool = None # WorkerPool for scan_branch, or None to run serially
+repository_pool = None # WorkerPool for scan_repository, or None
+
+def ordered_map(pool, function, items):
+    """Yield function(item) for items in order, running the calls on pool
+    if there is one. Calls that have not started are abandoned if the
+    generator is closed early."""
+    if pool is None:
+        for item in items:
+            yield function(item)
+        return
+    tasks = [pool.submit(function, item) for item in items]
+    try:
+        for task in tasks:
+            yield task.wait()
+    finally:
+        for task in tasks:
+            task.cancelled = True
+
+def ref_stamp(repod, names):
+    """Return something which changes if any of names could resolve
+    differently in repod, found without running git"""
+    paths = ['packed-refs']
+    for name in names:
+        # the places rev-parse and cat-file look for a ref
+        paths += [name, 'refs/'+name, 'refs/tags/'+name, 'refs/heads/'+name,
+                  'refs/remotes/'+name, 'refs/remotes/'+name+'/HEAD']
+    return [file_stamp(repod+'/'+path) for path in paths]
+
+class PollState:
+    """What scan_repository found for each branch and repository on earlier
+    runs, along with a ref_stamp of the refs it looked at, so that a
+    repository whose refs have not changed can be answered without git"""
+    version = 1
+
+    def __init__(self, filename, invalidate):
+        self.filename = filename
+        self.lock = Lock()
+        self.entries = {} # { branch : { repod : entry } }
+        self.hits = self.misses = 0
+        if invalidate:
+            return
+        try:
+            saved = load(file(filename, 'r'))
+        except (IOError, ValueError):
+            return
+        if saved.get('version') == self.version:
+            self.entries = saved['entries']
+
+    def lookup(self, branch, repod, fallback, latest_tag, stamp):
+        """Return the saved branch description, head revision and whether
+        latest_tag is the head, or None if we cannot trust them"""
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(branch, {}).get(repod)
+            if (entry is None or entry['stamp'] != stamp or 
+                entry['fallback'] != fallback or entry['latest_tag'] != latest_tag):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry['branchdes'], entry['head'], entry['latest_tag_is_head']
+        finally:
+            self.lock.release()
+
+    def record(self, branch, repod, fallback, latest_tag, stamp, 
+               branchdes, headrev, latest_tag_is_head):
+        """Remember what scan_repository found"""
+        self.lock.acquire()
+        try:
+            self.entries.setdefault(branch, {})[repod] = {
+                'stamp':stamp, 'fallback':fallback, 'latest_tag':latest_tag,
+                'branchdes':branchdes, 'head':headrev, 
+                'latest_tag_is_head':latest_tag_is_head}
+        finally:
+            self.lock.release()
+
+    def discard(self):
+        """Forget everything, since it has turned out to be wrong"""
+        self.lock.acquire()
+        try:
+            self.entries = {}
+        finally:
+            self.lock.release()
+
+    def save(self):
+        """Write the state back to its file"""
+        if options.time_commands:
+            print >> stderr, 'poll state matched %d of %d repository scans' % (
+                self.hits, self.hits+self.misses)
+        tmp = self.filename+'.tmp'
+        self.lock.acquire()
+        try:
+            with open(tmp, 'w') as fout:
+                dump({'version':self.version, 'entries':self.entries}, fout)
+            rename(tmp, self.filename)
+        except (IOError, OSError), exc:
+            print >> stderr, 'WARNING: unable to write', self.filename, exc
+        finally:
+            self.lock.release()
+
+poll_state = None # PollState if we have a state file
+
+def scan_repository(work):
+    """Return name, repod, head description, head revision and whether
+    latest_tag is at the head of repo, given work describing
+    repo, branch, fallback branch and latest_tag"""
+    repo, branch, fallback, latest_tag = work
+    repod = options.repository_base+'/'+repo['name']+'.git'
+    if poll_state is not None:
+        stamp = ref_stamp(repod, [branch, fallback, latest_tag])
+        cached = poll_state.lookup(branch, repod, fallback, latest_tag, stamp)
+        if cached is not None and not options.tag:
+            return (repo['name'], repod) + cached
+    branchdes, headrev = find_head(repod, branch, fallback)
+    if headrev is None:
+        return repo['name'], repod, None, None, False
+    try:
+        latest_tag_rev = get_resolver(repod).verify(latest_tag+'^{commit}')
+    except CalledProcessError:
+        # this can happen if do_tag is killed so we don't fail
+        # or if the repository is new, so we don't even warn
+        latest_tag_is_head = False
+    else:
+        latest_tag_is_head = latest_tag_rev == headrev
+    if poll_state is not None:
+        # when tagging we always look, and check the state file would 
+        # have told us the same thing
+        if cached is not None and cached != (branchdes, headrev, latest_tag_is_head):
+            print >> stderr, 'WARNING: poll state for', repod, 'on', branch, \
+                'was out of date so discarding it all'
+            poll_state.discard()
+        poll_state.record(branch, repod, fallback, latest_tag, stamp,
+                          branchdes, headrev, latest_tag_is_head)
+    return repo['name'], repod, branchdes, headrev, latest_tag_is_head
+
+def scan_branch(branch):
+    """Gather everything handle_branch needs to know about branch,
+    without producing any output"""
+    blob, extn = fetch_repolist(branch)
+    record = read_manifest(blob, extn)
+    latest_tag = get_latest_tag(branch, options.tag_format)
+    work = []
+    if record is not None:
+        work = [(repo, branch, record['fallback'], latest_tag) for repo in
+                record['repositories'] if repo.get('type', 'git') == 'git' and 
+                not repo.get('skip')]
+    found = []
+    results = ordered_map(repository_pool, scan_repository, work)
+    for result in results:
+        found.append(result)
+        _, _, _, headrev, latest_tag_is_head = result
+        if headrev is None:
+            break
+        if not options.tag and not latest_tag_is_head:
+            # once we have found one untagged repository there
+            # is no need to scan the others
+            break
+    results.close()
+    return {'branch': branch, 'record': record, 
+            'latest_tag': latest_tag, 'found': found}
+
+def handle_branch(scan, tag_format):
+    """Report on the branch described by scan, and tag it if requested"""
+    branch = scan['branch']
     if options.verbose:
         print >> stderr, 'working on branch', branch
     heads = []
     untagged = set()
-    record = get_repolist(branch)
+    record = check_repositories(scan['record'], 'on '+branch)
     if options.dump_json:
         with open(options.dump_json, 'w') as fout:
             dump(record, fout, indent=4)
-    latest_tag = get_latest_tag(branch, tag_format)
+    latest_tag = scan['latest_tag']
     if latest_tag is None:
         print >> stderr, 'WARNING: no tag found on', branch, 'in', \
             options.inspection_repository
@@ -242,38 +868,20 @@ def handle_branch(branch, tag_format):
         print >> stderr, 'latest tag starting %s on %s is %s' % (
             args[0], branch, latest_tag)
         
-    for repo in record['repositories']:
-        if repo.get('type', 'git') != 'git':
-            continue
-        if repo.get('skip'): 
-            continue
-        repod = options.repository_base+'/'+repo['name']+'.git'
-        branchdes, headrev = obtain_head(repod, branch, record['fallback'])
+    for name, repod, branchdes, headrev, latest_tag_is_head in scan['found']:
+        if headrev is None:
+            print >> stderr, repod, 'has neither', branch, 'nor', record['fallback']
+            exit(6)
         heads.append((repod, headrev))
-        try:
-            out = command([GIT_BINARY, '--git-dir='+repod, 'rev-parse', '-q',
-                           '--verify', latest_tag+'^{commit}'])
-        except CalledProcessError:
-            # this can happen if do_tag is killed so we don't fail
-            # or if the repository is new, so we don't even warn
-            latest_tag_is_head = False
-        else:
-            latest_tag_rev = out.strip()
-            latest_tag_is_head = latest_tag_rev == headrev
         if latest_tag_is_head:
             excontext = ' '+latest_tag
         else:
             excontext = ' UNTAGGED'
-            untagged.add(repo['name'])
+            untagged.add(name)
 
         if options.verbose:
             print >> stderr, '%50s using %15s is %s%s' % (
-                repo['name'], branchdes, headrev, excontext)
-
-        if not options.tag and not latest_tag_is_head:
-            # once we have found one untagged repository there
-            # is no need to scan the others
-            break
+                name, branchdes, headrev, excontext)
 
     if len(untagged) == 0:
         if options.tag and not options.force:
@@ -288,8 +896,21 @@ def handle_branch(branch, tag_format):
         tagnum = allocate_tag_number()
         tag = tag_format % (tag_prefix, tagnum, branch)
         print tagnum
-        for repod, revision in heads:
-            set_tag(tag, repod, revision)
+        set_tags(tag, heads)
+        # so that tagging another branch on this run allocates a new number
+        get_tag_index(options.repository_base+'/'+
+                      options.inspection_repository+'.git').add(tag)
+        if poll_state is not None:
+            # the new tag is now the latest, and at the head of everything
+            # we tagged; the head is found again after taking the stamp in
+            # case someone pushed since the scan, so that the next poll
+            # still tags their push
+            for name, repod, _, headrev, _ in scan['found']:
+                stamp = ref_stamp(repod, [branch, record['fallback'], tag])
+                get_resolver(repod).forget([branch, record['fallback']])
+                branchdes, head = find_head(repod, branch, record['fallback'])
+                poll_state.record(branch, repod, record['fallback'], tag, stamp,
+                                  branchdes, head, head == headrev)
 
 def main():
     """make tag"""
@@ -305,10 +926,20 @@ def main():
     if len(args) != 1:
         print >> stderr, 'ERROR: specify exactly one tag prefix as an argument'
         exit(7)
-    global tag_prefix
+    global tag_prefix, branch_pool, repository_pool, poll_state
     tag_prefix = args[0]
-    for branch in branches:
-        handle_branch(branch, options.tag_format)
+    if options.state_file and not options.server:
+        poll_state = PollState(options.state_file, options.invalidate_state)
+        register(poll_state.save)
+    if options.jobs > 1:
+        repository_pool = WorkerPool(options.jobs)
+        if not options.tag:
+            # tagging a branch could change what we find on a later one
+            # so only look ahead when inspecting
+            branch_pool = WorkerPool(options.jobs)
+    prefetch_repolists(branches)
+    for scan in ordered_map(branch_pool, scan_branch, branches):
+        handle_branch(scan, options.tag_format)
 
 if __name__ == '__main__':
     main()
@@ -2,72 +2,153 @@
 BUILD_NO=$1
 BRANCH=$2
 
+SCRIPTS=$(cd $(dirname $0) && pwd)
 BUILD_SCRIPTS_HOME=docs_build_scripts.git
 DOCS_HOME=docs_stage.git
 DOCTOOLS_HOME=${DOCS_HOME}/doctools
 IDL_HOME=docs_idl.git
 DOCS_OUT=docs_out
 
-/bin/rm -rf ${BUILD_SCRIPTS_HOME} ${DOCS_HOME} ${IDL_HOME} ${DOCS_OUT}
-mkdir -p ${DOCS_OUT}
+# Built PDFs are kept in DOCS_CACHE under the hash of their inputs, so a
+# document which has not changed since an earlier build is not rebuilt
+DOCS_CACHE=${DOCS_CACHE:-${HOME}/docs-cache}
+DOCS_CACHE_DAYS=30
+JOBS=${JOBS:-$(getconf _NPROCESSORS_ONLN)}
 
-git clone git://git.xci-test.com/xenclient/build-scripts.git ${BUILD_SCRIPTS_HOME}
+# Clone a repository from the mirror kept under ~/git-mirrors, which is
+# shared with the builds using git_checkout in buildbot2.cfg
+clone_from_mirror() {
+	local url=$1 dest=$2
+	local mirror=${HOME}/git-mirrors/xenclient/$(basename ${url})
+	mkdir -p $(dirname ${mirror})
+	(
+		flock -w 3600 9 || exit 1
+		if [ ! -d ${mirror} ] || ! git --git-dir=${mirror} fetch --prune origin; then
+			rm -rf ${mirror} ${mirror}.new
+			git clone --mirror ${url} ${mirror}.new && mv ${mirror}.new ${mirror} || exit 1
+		fi
+		flock -s 9
+		# like the old checkout, carry on with master if there is no such branch
+		local branch=${BRANCH}
+		if ! git --git-dir=${mirror} rev-parse --verify -q refs/heads/${branch} > /dev/null; then
+			echo [$(basename ${url}) has no branch ${branch}, using master]
+			branch=master
+		fi
+		git clone --branch ${branch} ${mirror} ${dest} || exit 1
+		cd ${dest} && git config remote.origin.url ${url}
+	) 9>${mirror}.lock
+}
+
+# Build one document in a copy of its directory holding no other
+# document, apart from those it includes, and keep its PDFs in the cache
+build_document() {
+	local lang=$1 dir=$2 doc=$3 hash=$4
+	local name=$(basename ${doc} .xml)
+	local stage=$(dirname ${dir})/.build-${name}
+	local cached=${DOCS_CACHE}/${lang}/${name}-${hash}
+	local inputs=$(${SCRIPTS}/docs_inputs.py --inputs ${doc})
+	local included=
+	rm -rf ${stage} ${cached}.tmp-$$
+	cp -a ${dir} ${stage}
+	rm -rf ${stage}/out
+	for other in ${stage}/*.xml; do
+		other=$(basename ${other})
+		if [ ${other} = ${name}.xml ]; then
+			continue
+		elif echo "${inputs}" | grep -qxF ${dir}/${other}; then
+			included="${included} ${other%.xml}.pdf"
+		else
+			rm -f ${stage}/${other}
+		fi
+	done
+	sed -i -e "s/<?dbtimestamp format=\"d B Y\"?>/<?dbtimestamp format=\"d B Y\"?> (build "$BUILD_NO")/" ${stage}/${name}.xml
 
-if [ x${BRANCH} != "xmaster" ];
-then
-(cd ${BUILD_SCRIPTS_HOME} && git checkout -b ${BRANCH} origin/${BRANCH} || exit 1 ) 
-fi
+	if ! (cd ${stage} && ./build.sh) > ${stage}.log 2>&1; then # && ./build_html_chunked.sh
+		cat ${stage}.log
+		echo [Failed to build ${doc}]
+		return 1
+	fi
+	cat ${stage}.log
+	mkdir -p ${cached}.tmp-$$
+	for pdf in ${stage}/out/pdf/*.pdf; do
+		# build.sh also builds the documents this one includes, whose PDFs
+		# come from their own builds
+		if [ -f $pdf ] && ! echo " ${included} " | grep -qF " $(basename $pdf) "; then
+			install -m 644 -c $pdf ${cached}.tmp-$$
+		fi
+	done
+	rm -rf ${cached}
+	mv -T ${cached}.tmp-$$ ${cached} || rm -rf ${cached}.tmp-$$
+	rm -rf ${stage} ${stage}.log
+	echo [Built ${doc}]
+}
+export -f build_document
+export BUILD_NO DOCS_CACHE SCRIPTS
 
-git clone git://git.xci-test.com/xenclient/docs.git ${DOCS_HOME}
+/bin/rm -rf ${BUILD_SCRIPTS_HOME} ${DOCS_HOME} ${IDL_HOME} ${DOCS_OUT}
+mkdir -p ${DOCS_OUT}
 
-if [ x${BRANCH} != "xmaster" ];
-then
-(cd ${DOCS_HOME} && git checkout -b ${BRANCH} origin/${BRANCH} || exit 1 ) 
-fi
+clone_from_mirror git://git.xci-test.com/xenclient/build-scripts.git ${BUILD_SCRIPTS_HOME} || exit 1
+clone_from_mirror git://git.xci-test.com/xenclient/docs.git ${DOCS_HOME} || exit 1
 
 ${DOCS_HOME}/doctools/update_version_ents.sh ${BUILD_SCRIPTS_HOME}/version ${DOCS_HOME}/xml/en_us/docbook/shared/
 
 XSL_PATH=${DOCS_HOME}/doctools/idl_to_docbook/
 
-git clone git://git.xci-test.com/xenclient/idl.git ${IDL_HOME}
-if [ x${BRANCH} != "xmaster" ];
-then
-(cd ${IDL_HOME} && git checkout -b ${BRANCH} origin/${BRANCH} || exit 1 ) 
-fi
-
-( cd ${IDL_HOME} && git checkout -b ${BRANCH} origin/${BRANCH} || exit 1)
+clone_from_mirror git://git.xci-test.com/xenclient/idl.git ${IDL_HOME} || exit 1
 
 ${DOCS_HOME}/doctools/idl_to_docbook/update_idl_doc_ents.sh ${IDL_HOME}/interfaces/ ${DOCS_HOME}/xml/en_us/docbook/shared/ ${XSL_PATH}
 
 #"ja" "fr" "it" "xh_hans" "es" "de"
 
-for lang in "en_us" 
+FAILED=0
+for lang in "en_us"
 do
 	echo [Building PDFs for language ${lang}]
 	/bin/rm -rf ${DOCS_HOME}/${lang}
-	mkdir -p ${DOCS_OUT}/${lang}
-	
-	(cd ${DOCS_OUT}/${lang} && rm -r *)
-	
+	mkdir -p ${DOCS_OUT}/${lang} ${DOCS_CACHE}/${lang}
+
+	(cd ${DOCS_OUT}/${lang} && rm -rf *)
+
 	for dir in "${DOCS_HOME}/xml/${lang}/docbook/public"
 	do
-		for d in $dir/*.xml; do
-			if [ -f $d ]; then
-				sed -i -e "s/<?dbtimestamp format=\"d B Y\"?>/<?dbtimestamp format=\"d B Y\"?> (build "$BUILD_NO")/" $d
-			fi
-		done
+		# the inputs are hashed after the entities are updated but before
+		# the build number goes in, which would make every hash new
+		EXTRA=$(find ${dir} -maxdepth 1 -type f ! -name '*.xml' -printf "--extra %p ")
+		${SCRIPTS}/docs_inputs.py --extra ${DOCTOOLS_HOME} ${EXTRA} ${dir}/*.xml > ${dir}.hashes || exit 1
 
-		(cd $dir && ./build.sh || exit 1) # && ./build_html_chunked.sh
-	
-		for pdf in $dir/out/pdf/*.pdf; do 
-			if [ -f $pdf ]; then
-				install -m 644 -c $pdf  ${DOCS_OUT}/${lang}
+		STALE=
+		NAMES=
+		while read hash doc; do
+			name=$(basename ${doc} .xml)
+			if [ -d ${DOCS_CACHE}/${lang}/${name}-${hash} ]; then
+				echo [Reusing ${doc} from an earlier build]
+				touch ${DOCS_CACHE}/${lang}/${name}-${hash}
+			else
+				STALE="${STALE} ${lang} ${dir} ${doc} ${hash}"
+				NAMES="${NAMES} ${name}"
 			fi
-		done
-	
+		done < ${dir}.hashes
+
+		if [ -n "${STALE}" ]; then
+			echo [Building${NAMES} with ${JOBS} jobs]
+			echo ${STALE} | xargs -n 4 -P ${JOBS} bash -c 'build_document "$@"' build_document || FAILED=1
+		fi
+
+		while read hash doc; do
+			name=$(basename ${doc} .xml)
+			for pdf in ${DOCS_CACHE}/${lang}/${name}-${hash}/*.pdf; do
+				if [ -f $pdf ]; then
+					install -m 644 -c $pdf  ${DOCS_OUT}/${lang}
+				fi
+			done
+		done < ${dir}.hashes
+
 		# tar cfC - $dir/out/html . | tar xvfC - ${DOCS_OUT}/${lang}
-		
-	
+
+
 	done
-done 
+	find ${DOCS_CACHE}/${lang} -mindepth 1 -maxdepth 1 -mtime +${DOCS_CACHE_DAYS} -exec rm -rf {} +
+done
 rm -rf ${BUILD_SCRIPTS_HOME} ${DOCS_HOME} ${IDL_HOME}
+exit ${FAILED}
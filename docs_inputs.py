@@ -0,0 +1,133 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2014 Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Print a hash of the inputs of each docbook document named on the
+command line, as a line of the form HASH DOCUMENT.
+
+The inputs of a document are the document itself and everything it
+reaches through SYSTEM entities, XInclude and image references, so the
+shared version and IDL entities are included as soon as a document uses
+them, plus the files and directories given with --extra, such as the
+stylesheets and build script. A document's hash changes only when
+something which could change its output changes.
+
+With --inputs the files each document reaches are listed instead, one
+to a line, which docs_build.sh uses to keep the other files in the
+directory of a document that it includes."""
+
+from optparse import OptionParser
+from os import walk
+from os.path import join, dirname, normpath, relpath, isdir, isfile
+from hashlib import sha1
+from re import compile
+from sys import stderr
+from cache_store import file_hash
+
+REFERENCE_RE = compile(r'''(?:SYSTEM|PUBLIC\s+(?:"[^"]*"|'[^']*'))\s+(?:"([^"]+)"|'([^']+)')|'''
+                       r'''\b(?:href|fileref)\s*=\s*(?:"([^"]+)"|'([^']+)')''')
+TEXT_SUFFIXES = ['.xml', '.ent', '.mod', '.dtd', '.xsl']
+
+def read_options():
+    """Read command line options"""
+    global options, documents
+    parser = OptionParser(usage='%prog [options] DOCUMENT...')
+    parser.add_option('-e', '--extra', metavar='PATH', action='append', default=[],
+                      help='Count PATH, a file or directory, as an input of every document')
+    parser.add_option('-r', '--root', metavar='DIRECTORY', default='.',
+                      help='Name inputs relative to DIRECTORY in the hash, so that it '
+                      'does not depend on where the sources are')
+    parser.add_option('-i', '--inputs', action='store_true',
+                      help='List the files each document reaches instead of hashing')
+    options, documents = parser.parse_args()
+    if not documents:
+        parser.error('specify at least one document')
+
+def references(path):
+    """Return the local files which the text file at path refers to"""
+    f = open(path)
+    try:
+        text = f.read()
+    finally:
+        f.close()
+    found = []
+    for match in REFERENCE_RE.finditer(text):
+        name = [g for g in match.groups() if g][0]
+        # DTDs named by URL come from the XML catalog, not the sources
+        if '://' in name or name.startswith('#'):
+            continue
+        found.append(normpath(join(dirname(path), name.split('#')[0])))
+    return found
+
+def document_inputs(document, hashes):
+    """Return the set of files which document reaches, hashing each into
+    hashes { path : sha1 } if it is not there already"""
+    seen = set()
+    pending = [normpath(document)]
+    while pending:
+        path = pending.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        if not isfile(path):
+            # missing references fail the build, but still count them
+            print >>stderr, 'WARNING:', document, 'refers to missing', path
+            hashes[path] = 'missing'
+            continue
+        if path not in hashes:
+            hashes[path] = file_hash(path)
+        if [s for s in TEXT_SUFFIXES if path.endswith(s)]:
+            pending.extend(references(path))
+    return seen
+
+def extra_inputs(paths, hashes):
+    """Return the set of files in or at paths, hashing them into hashes"""
+    found = set()
+    for path in paths:
+        if isdir(path):
+            files = []
+            for root, dirs, names in walk(path):
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                files.extend([join(root, name) for name in names])
+        else:
+            files = [path]
+        for name in files:
+            name = normpath(name)
+            if isfile(name):
+                hashes[name] = file_hash(name)
+                found.add(name)
+    return found
+
+def inputs_hash(files, hashes):
+    """Return a hash of the names and contents of files"""
+    digest = sha1()
+    for path in sorted(files):
+        digest.update('%s %s\n' % (relpath(path, options.root), hashes[path]))
+    return digest.hexdigest()
+
+if __name__ == '__main__':
+    read_options()
+    hashes = {}
+    extra = extra_inputs(options.extra, hashes)
+    for document in documents:
+        files = document_inputs(document, hashes)
+        if options.inputs:
+            for path in sorted(files):
+                print path
+        else:
+            print inputs_hash(files | extra, hashes), document
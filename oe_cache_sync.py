@@ -0,0 +1,330 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2014 Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Keep a slave's OE download directory in step with the central download
+cache, which is indexed by a manifest of each file's size, modification
+time and sha1.
+
+pull copies the files the slave lacks into a store on the slave named by
+their sha1, shared by the builders on the slave, and hard links them into
+the download directory. push copies back only the files which the
+central cache lacks or has older copies of. Several slaves may push at
+once: files are staged under temporary names and renamed into place with
+the manifest update while holding the manifest lock.
+
+Files may also be put in the central cache by other means, since pull
+and index bring the manifest up to date with the cache first, hashing
+only the files whose size or modification time changed."""
+
+from optparse import OptionParser
+from os import walk, lstat, readlink, symlink, rename, lchown
+from os.path import join, exists, relpath, dirname
+from stat import S_ISREG, S_ISLNK
+from pwd import getpwnam
+from time import time
+from sys import stderr
+from cache_store import file_hash, copy_file, link_file, remove_file, \
+    object_path, make_directories, temporary_name, locked, read_manifest, \
+    write_manifest, Progress
+
+MANIFEST_NAME = '.oe-cache-manifest.json'
+LOCK_NAME = '.oe-cache-manifest.lock'
+STATE_NAME = '.oe-cache-state.json'
+SKIP_PREFIXES = ['.oe-cache']
+SKIP_SUFFIXES = ['.lock']
+
+def read_options():
+    """Read command line options"""
+    global options, command
+    parser = OptionParser(usage='%prog [options] pull|push|index')
+    parser.add_option('-c', '--cache', metavar='DIRECTORY',
+                      help='The central download cache is DIRECTORY')
+    parser.add_option('-d', '--directory', metavar='DIRECTORY', default='oe-download',
+                      help='The download directory of this build is DIRECTORY')
+    parser.add_option('-s', '--store', metavar='DIRECTORY', default='oe-store',
+                      help='Keep pulled files in DIRECTORY, which should be on the same '
+                      'file system as the download directory and can be shared by builders')
+    parser.add_option('-u', '--user', metavar='USER',
+                      help='Pulled files and directories belong to USER')
+    parser.add_option('--link-min', metavar='BYTES', type='int', default=1024*1024,
+                      help='Copy files smaller than BYTES rather than linking them, since '
+                      'small files such as fetch stamps may be rewritten in place')
+    parser.add_option('--prune-days', metavar='DAYS', type='int', default=7,
+                      help='Delete objects in the store unlinked for DAYS after a pull')
+    options, args = parser.parse_args()
+    if len(args) != 1 or args[0] not in ['pull', 'push', 'index']:
+        parser.error('specify pull, push or index')
+    if options.cache is None:
+        parser.error('specify the central cache with --cache')
+    command = args[0]
+
+def skip(name):
+    """Should the file name be left out of the cache?"""
+    return ([p for p in SKIP_PREFIXES if name.startswith(p)] or
+            [s for s in SKIP_SUFFIXES if name.endswith(s)] or '.tmp-' in name)
+
+def list_files(top, progress=None):
+    """Return { relative path : lstat } of the files and symlinks under top"""
+    files = {}
+    for root, dirs, names in walk(top):
+        for name in names:
+            if skip(name):
+                continue
+            path = join(root, name)
+            st = lstat(path)
+            if S_ISREG(st.st_mode) or S_ISLNK(st.st_mode):
+                files[relpath(path, top)] = st
+                if progress:
+                    progress.update()
+    return files
+
+def entry_for(path, st, digest):
+    """Return the manifest entry of path, which is [size, mtime, sha1]
+    for a file and [target] for a symlink"""
+    if S_ISLNK(st.st_mode):
+        return [readlink(path)]
+    return [st.st_size, int(st.st_mtime), digest]
+
+def unchanged(st, known):
+    """Is the file with lstat st still as it was when recorded as known?"""
+    return (known is not None and len(known) == 3 and
+            known[0] == st.st_size and known[1] == int(st.st_mtime))
+
+def place_symlink(target, path, uid=None):
+    """Make path a symlink to target, replacing whatever is there"""
+    make_directories(dirname(path), uid)
+    temporary = temporary_name(path)
+    remove_file(temporary)
+    symlink(target, temporary)
+    if uid is not None:
+        lchown(temporary, uid, -1)
+    rename(temporary, path)
+
+def index_cache(cache):
+    """Bring the central manifest up to date with the files in the cache,
+    hashing only those whose size or modification time changed. The
+    hashing is done outside the manifest lock, which is held only to
+    record the results, so that pulls and pushes are not held up."""
+    manifest_path = join(cache, MANIFEST_NAME)
+    lock_path = join(cache, LOCK_NAME)
+    with locked(lock_path, exclusive=False):
+        manifest = read_manifest(manifest_path)
+    files = list_files(cache, Progress('listed'))
+    changes = {} # { name : (entry read, lstat, new entry) }
+    progress = Progress('hashed')
+    for name, st in sorted(files.iteritems()):
+        known = manifest.get(name)
+        if S_ISLNK(st.st_mode) or not unchanged(st, known):
+            digest = None
+            if S_ISREG(st.st_mode):
+                digest = file_hash(join(cache, name))
+                progress.update(st.st_size)
+            entry = entry_for(join(cache, name), st, digest)
+            if entry != known:
+                changes[name] = (known, st, entry)
+    gone = [name for name in manifest if name not in files]
+    if not changes and not gone:
+        print 'INFO: indexed %d files in %s, all up to date' % (len(manifest), cache)
+        return manifest
+
+    with locked(lock_path):
+        manifest = read_manifest(manifest_path)
+        updated = 0
+        for name, (known, st, entry) in changes.iteritems():
+            # skip files which a push replaced while they were hashed
+            try:
+                now = lstat(join(cache, name))
+            except OSError:
+                continue
+            if manifest.get(name) != known or (now.st_size, now.st_mtime) != (st.st_size, st.st_mtime):
+                continue
+            manifest[name] = entry
+            updated += 1
+        removed = 0
+        for name in gone:
+            if name in manifest and not exists(join(cache, name)):
+                del manifest[name]
+                removed += 1
+        write_manifest(manifest_path, manifest)
+    print 'INFO: indexed %d files in %s, hashing %d (%.1f MB), updating %d and removing %d' % (
+        len(manifest), cache, progress.files, progress.size / 1048576.0, updated, removed)
+    return manifest
+
+def prune_store(store, days):
+    """Delete objects which no download directory has linked for days"""
+    cutoff = time() - days * 24 * 3600
+    pruned = 0
+    for root, dirs, names in walk(store):
+        for name in names:
+            path = join(root, name)
+            st = lstat(path)
+            # linking and unlinking an object change its ctime
+            if st.st_nlink == 1 and st.st_ctime < cutoff:
+                remove_file(path)
+                pruned += 1
+    return pruned
+
+def pull():
+    cache, directory, store = options.cache, options.directory, options.store
+    uid = None
+    if options.user:
+        uid = getpwnam(options.user).pw_uid
+    manifest = index_cache(cache)
+    state_path = join(directory, STATE_NAME)
+    make_directories(directory, uid)
+    state = read_manifest(state_path)
+
+    copied = linked = current = newer = 0
+    copied_bytes = 0
+    progress = Progress('checked')
+    for name, entry in sorted(manifest.iteritems()):
+        progress.update()
+        path = join(directory, name)
+        try:
+            st = lstat(path)
+        except OSError:
+            st = None
+        if len(entry) == 1:
+            if st and S_ISLNK(st.st_mode) and readlink(path) == entry[0]:
+                current += 1
+            else:
+                place_symlink(entry[0], path, uid)
+                linked += 1
+            state[name] = entry
+            continue
+        size, mtime, digest = entry
+        known = state.get(name)
+        if st and unchanged(st, known) and known[2] == digest:
+            current += 1
+            continue
+        if st and int(st.st_mtime) > mtime:
+            # like rsync -u, keep files which are newer here
+            newer += 1
+            continue
+        source = join(cache, name)
+        try:
+            if size < options.link_min:
+                digest = copy_file(source, path, uid)
+                copied += 1
+                copied_bytes += size
+            else:
+                obj = object_path(store, digest)
+                if not exists(obj):
+                    got = copy_file(source, obj, uid)
+                    if got != digest:
+                        print >>stderr, 'WARNING:', source, 'changed since it was indexed'
+                        digest = got
+                        make_directories(dirname(object_path(store, digest)), uid)
+                        rename(obj, object_path(store, digest))
+                        obj = object_path(store, digest)
+                    copied += 1
+                    copied_bytes += size
+                link_file(obj, path, uid)
+                linked += 1
+        except (IOError, OSError), exc:
+            print >>stderr, 'WARNING: unable to pull', name, exc
+            continue
+        st = lstat(path)
+        state[name] = entry_for(path, st, digest)
+    write_manifest(state_path, state)
+    pruned = prune_store(store, options.prune_days) if exists(store) else 0
+
+    print 'INFO: %d files in %s: copied %d (%.1f MB), linked %d, %d up to date, %d newer here' % (
+        len(manifest), cache, copied, copied_bytes / 1048576.0, linked, current, newer)
+    if pruned:
+        print 'INFO: pruned %d unused objects from %s' % (pruned, store)
+
+def push():
+    cache, directory = options.cache, options.directory
+    manifest_path = join(cache, MANIFEST_NAME)
+    lock_path = join(cache, LOCK_NAME)
+    state_path = join(directory, STATE_NAME)
+    state = read_manifest(state_path)
+    with locked(lock_path, exclusive=False):
+        manifest = read_manifest(manifest_path)
+
+    # Stage the files to send outside the lock, which is only needed to
+    # put them in place
+    staged = {} # { name : (staging path, manifest entry) }
+    sent_bytes = 0
+    progress = Progress('checked')
+    for name, st in sorted(list_files(directory).iteritems()):
+        progress.update()
+        path = join(directory, name)
+        central = manifest.get(name)
+        if S_ISLNK(st.st_mode):
+            entry = entry_for(path, st, None)
+            if central != entry:
+                staged[name] = (None, entry)
+            state[name] = entry
+            continue
+        known = state.get(name)
+        digest = None
+        if unchanged(st, known):
+            digest = known[2]
+        if central is not None and len(central) == 3:
+            if central[2] == digest or central[1] >= int(st.st_mtime):
+                continue
+        if digest is None:
+            digest = file_hash(path)
+            state[name] = entry_for(path, st, digest)
+            if central is not None and len(central) == 3 and central[2] == digest:
+                continue
+        staging = temporary_name(join(cache, name))
+        try:
+            copy_file(path, staging)
+        except (IOError, OSError), exc:
+            print >>stderr, 'WARNING: unable to push', name, exc
+            remove_file(staging)
+            continue
+        staged[name] = (staging, entry_for(path, st, digest))
+        state[name] = staged[name][1]
+        sent_bytes += st.st_size
+
+    with locked(lock_path):
+        manifest = read_manifest(manifest_path)
+        sent = 0
+        for name, (staging, entry) in sorted(staged.iteritems()):
+            central = manifest.get(name)
+            if (staging is not None and central is not None and
+                len(central) == 3 and central[1] >= entry[1]):
+                # another slave pushed a copy at least as new meanwhile
+                remove_file(staging)
+                continue
+            if staging is None:
+                place_symlink(entry[0], join(cache, name))
+            else:
+                rename(staging, join(cache, name))
+            manifest[name] = entry
+            sent += 1
+        if sent:
+            write_manifest(manifest_path, manifest)
+    write_manifest(state_path, state)
+    print 'INFO: sent %d files (%.1f MB) to %s' % (sent, sent_bytes / 1048576.0, cache)
+
+if __name__ == '__main__':
+    read_options()
+    t0 = time()
+    if command == 'pull':
+        pull()
+    elif command == 'push':
+        push()
+    else:
+        index_cache(options.cache)
+    print 'TIMING: %s took %.1f seconds' % (command, time() - t0)
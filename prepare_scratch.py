@@ -20,7 +20,8 @@
 from optparse import OptionParser
 from os.path import exists, abspath, realpath, split, islink, join
 from subprocess import check_call, call, PIPE, CalledProcessError, Popen
-from os import mkdir, chown, chdir, getcwd, readlink
+from os import mkdir, chown, chdir, getcwd, readlink, rename, listdir, statvfs, setsid, getpid
+from select import poll, POLLPRI, POLLERR
 from time import time, sleep
 from sys import stderr
 
@@ -38,30 +39,42 @@ def check_output(*popenargs, **kwargs):
         raise error
     return output
 
-parser = OptionParser()
-parser.add_option('-u', '--user', metavar='USER', help='Chown directory to USER', default='build')
-parser.add_option('-d', '--directory', metavar='DIRECTORY', help='Prepare DIRECTORY', default='scratch')
-parser.add_option('-b', '--block-device', metavar='DEVICE', help='Use DEVICE to store DIRECTORY', default='/dev/md/buildtemp')
-options, _ = parser.parse_args()
+TRASH_PREFIX = '.trash-'
+KEEP = [TRASH_PREFIX, 'lost+found']
 
-directory = abspath(options.directory)
-block_device = realpath(options.block_device)
-print 'INFO: looking for users of', block_device
-make_it = lambda: check_call(['mkdir', '-p', directory])
-if not exists(options.block_device):
-    check_call(['rm', '-rf', directory])
-    make_it()
-else:
+def timed(phase, function, *args):
+    """Call function with args and report how long it took"""
+    t0 = time()
+    result = function(*args)
+    print 'TIMING: %s took %.1f seconds' % (phase, time() - t0)
+    return result
+
+def find_mountpoint(mounts, device):
+    """Return where device is mounted according to the open /proc/mounts"""
+    mounts.seek(0)
+    mountpoint = None
+    for line in mounts.readlines():
+        spl = line.split()
+        if spl and spl[0] == device:
+            mountpoint = spl[1] # assume no spaces in directory name
+    return mountpoint
+
+def wait_for_mounts(mounts, timeout):
+    """Wait up to timeout seconds for the mount table to change since
+    mounts, an open /proc/mounts, was last polled"""
+    p = poll()
+    p.register(mounts, POLLPRI | POLLERR)
+    return p.poll(int(max(timeout, 0) * 1000))
+
+def umount_device(device, directory):
+    """Kill the users of device and unmount it wherever it is mounted"""
+    mounts = file('/proc/mounts')
     t0 = time()
     while True:
-        mountpoint = None
-        for line in file('/proc/mounts').readlines():
-            spl = line.split()
-            if spl and spl[0] == block_device:
-                mountpoint = spl[1] # assume no spaces in directory name
+        mountpoint = find_mountpoint(mounts, device)
         if mountpoint is None:
             break
-        print 'INFO:', block_device, 'mounted at', mountpoint
+        print 'INFO:', device, 'mounted at', mountpoint
         td = time() - t0
         if td > 60:
             print >>stderr, 'ERROR: unable to umount', directory, 'after', td, 'seconds'
@@ -72,10 +85,96 @@ else:
         rc2 = call(['umount', mountpoint])
         if rc2 != 0:
             print >>stderr, 'ERROR: umount failed with code', rc2
-        sleep(1)
-    check_call(['mkfs.ext3', block_device])
+            # the killed processes may take a moment to let go
+            wait_for_mounts(mounts, 1)
+        else:
+            wait_for_mounts(mounts, 60 - td)
+    mounts.close()
+
+def free_fraction(directory):
+    """Return the fraction of the file system holding directory that is free"""
+    st = statvfs(directory)
+    return float(st.f_bavail) / st.f_blocks
+
+def delete_in_background(path):
+    """Start deleting path in a process which outlives this one"""
+    null = open('/dev/null', 'r+')
+    Popen(['nice', 'ionice', '-c', '3', 'rm', '-rf', path], 
+          stdin=null, stdout=null, stderr=null, close_fds=True, preexec_fn=setsid)
+    null.close()
+
+def trash_in(directory):
+    """Return the trash directories in directory left by earlier resets"""
+    return [join(directory, name) for name in listdir(directory) if name.startswith(TRASH_PREFIX)]
+
+def reset_directory(directory):
+    """Move everything in directory, which must be the top of a file
+    system, into a trash directory in it and delete that in the background"""
+    # the trash of a reset moments ago may still be there
+    trash = join(directory, '%s%d-%d' % (TRASH_PREFIX, time(), getpid()))
+    mkdir(trash)
+    for name in listdir(directory):
+        if not [keep for keep in KEEP if name.startswith(keep)]:
+            rename(join(directory, name), join(trash, name))
+    delete_in_background(trash)
+
+def reset_mounted(block_device, directory, min_free):
+    """Reset directory if block_device is still mounted there with enough
+    room, and return True, or return False if it needs making afresh"""
+    mountpoint = find_mountpoint(file('/proc/mounts'), block_device)
+    if mountpoint is None or realpath(mountpoint) != realpath(directory):
+        print 'INFO:', block_device, 'is not mounted at', directory
+        return False
+    busy = trash_in(directory)
+    if busy:
+        # the deletion carries on alongside the build, so it only matters
+        # if it leaves too little room
+        print 'INFO: still deleting', ' '.join(busy)
+    free = free_fraction(directory)
+    if free < min_free:
+        print 'INFO: only %d%% of %s is free' % (100 * free, directory)
+        return False
+    timed('kill', call, ['fuser', '-v', '-k', '-M', '-m', directory])
+    # that killed the deletion of the earlier trash too
+    for trash in busy:
+        delete_in_background(trash)
+    timed('reset', reset_directory, directory)
+    return True
+
+parser = OptionParser()
+parser.add_option('-u', '--user', metavar='USER', help='Chown directory to USER', default='build')
+parser.add_option('-d', '--directory', metavar='DIRECTORY', help='Prepare DIRECTORY', default='scratch')
+parser.add_option('-b', '--block-device', metavar='DEVICE', help='Use DEVICE to store DIRECTORY', default='/dev/md/buildtemp')
+parser.add_option('-r', '--reset', action='store_true', 
+                  help='Empty DIRECTORY by moving its contents aside and deleting them in the background, '
+                  'rather than making a new file system, when DEVICE is already mounted there')
+parser.add_option('-f', '--min-free', metavar='PERCENT', type='int', default=25,
+                  help='Make a new file system anyway if less than PERCENT of DEVICE is free')
+options, _ = parser.parse_args()
+
+t_start = time()
+directory = abspath(options.directory)
+block_device = realpath(options.block_device)
+make_it = lambda: check_call(['mkdir', '-p', directory])
+if not exists(options.block_device):
+    if options.reset and exists(directory):
+        parent, name = split(directory)
+        # finish off any trash an interrupted deletion left behind
+        for trash in trash_in(parent):
+            if split(trash)[1].startswith(TRASH_PREFIX + name + '-'):
+                delete_in_background(trash)
+        trash = join(parent, '%s%s-%d' % (TRASH_PREFIX, name, time()))
+        timed('reset', rename, directory, trash)
+        delete_in_background(trash)
+    else:
+        timed('delete', check_call, ['rm', '-rf', directory])
     make_it()
-    check_call(['mount', block_device, directory])
+elif not (options.reset and reset_mounted(block_device, directory, options.min_free / 100.0)):
+    print 'INFO: looking for users of', block_device
+    timed('umount', umount_device, block_device, directory)
+    timed('mkfs', check_call, ['mkfs.ext3', block_device])
+    make_it()
+    timed('mount', check_call, ['mount', block_device, directory])
 
 check_call(['chown', options.user, directory])
-
+print 'TIMING: prepare_scratch took %.1f seconds' % (time() - t_start)
@@ -0,0 +1,276 @@
+#! /usr/bin/env python
+#
+# Copyright (c) 2014 Citrix Systems, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Share OE sstate objects between the builds on a slave, and between
+slaves through a central directory.
+
+fetch hard links every object in the slave's store into the sstate
+directory of a build, first copying in any objects used centrally
+since the last fetch, and sets their access times back so that publish
+can tell which ones the build read. publish moves the objects the build
+made into the store and the central directory, and reports how many
+objects were reused (hits) and made afresh (misses) on STATISTIC lines.
+The store is kept under --max-size and the central directory under
+--central-max-size by deleting the least recently used objects, where
+any slave's build reading or making an object counts as using it. fetch
+copies in the objects used centrally since the last fetch, most recent
+first, as long as they fit in the store. sstate object names already
+include their signature hash, so an object is never changed once made."""
+
+from optparse import OptionParser
+from os import walk, lstat, utime, link
+from os.path import join, exists, relpath, expanduser, dirname
+from errno import EEXIST, EXDEV
+from stat import S_ISREG
+from time import time
+from sys import stderr
+from cache_store import copy_file, link_file, remove_file, make_directories, \
+    locked, read_manifest, write_manifest, Progress
+
+LOCK_NAME = '.sstate-cache.lock' # in the store and the central directory
+USAGE_NAME = '.sstate-usage.json' # { name : time last used }, likewise
+FETCH_NAME = '.sstate-fetch.json' # the fetch time, in the build directory
+CENTRAL_NAME = '.sstate-central.json' # the last central fetch, in the store
+SIGNATURE_SUFFIX = '.siginfo' # signature data, not an object to count
+
+def read_options():
+    """Read command line options"""
+    global options, command
+    parser = OptionParser(usage='%prog [options] fetch|publish')
+    parser.add_option('-d', '--directory', metavar='DIRECTORY', default='oe-sstate',
+                      help='The sstate directory of this build is DIRECTORY')
+    parser.add_option('-s', '--store', metavar='DIRECTORY', default=expanduser('~/oe-sstate-store'),
+                      help='Keep objects shared by the builds on this slave in DIRECTORY, '
+                      'which must be on the same file system as the sstate directory')
+    parser.add_option('-c', '--central', metavar='DIRECTORY',
+                      help='Exchange objects with other slaves through DIRECTORY')
+    parser.add_option('-m', '--max-size', metavar='GB', type='float', default=100,
+                      help='Delete the least recently used objects to keep the store under GB')
+    parser.add_option('--central-max-size', metavar='GB', type='float', default=500,
+                      help='Likewise keep the central directory under GB')
+    options, args = parser.parse_args()
+    if len(args) != 1 or args[0] not in ['fetch', 'publish']:
+        parser.error('specify fetch or publish')
+    command = args[0]
+
+def list_objects(top, progress=None):
+    """Return { relative path : lstat } of the files under top"""
+    files = {}
+    if not exists(top):
+        return files
+    for root, dirs, names in walk(top):
+        for name in names:
+            if name.startswith('.sstate-') or '.tmp-' in name:
+                continue
+            path = join(root, name)
+            st = lstat(path)
+            if S_ISREG(st.st_mode):
+                files[relpath(path, top)] = st
+                if progress:
+                    progress.update()
+    return files
+
+def statistic(name, value):
+    """Report a value for the step statistics"""
+    print 'STATISTIC: %s %d' % (name, value)
+
+def fetch_central(central, store):
+    """Copy the objects used centrally since the last fetch into the
+    store, most recently used first while they fit under --max-size,
+    and return how many there were"""
+    state_path = join(store, CENTRAL_NAME)
+    last = read_manifest(state_path).get('time', 0)
+    started = time()
+    with locked(join(central, LOCK_NAME), exclusive=False):
+        central_usage = read_manifest(join(central, USAGE_NAME))
+    # publish stamps the manifest when it writes it, so nothing written
+    # after this fetch read it is older than started, but allow for the
+    # clocks of the slaves differing
+    recent = [(used, name) for name, used in central_usage.iteritems() if used >= last - 3600]
+    recent.sort(reverse=True)
+    room = options.max_size * 1024 ** 3 - sum([st.st_size for st in list_objects(store).itervalues()])
+    fetched = {} # { name : time last used centrally }
+    too_big = 0
+    progress = Progress('fetched')
+    for used, name in recent:
+        dest = join(store, name)
+        if exists(dest):
+            continue
+        try:
+            size = lstat(join(central, name)).st_size
+            if size > room:
+                too_big += 1
+                continue
+            copy_file(join(central, name), dest)
+        except (IOError, OSError), exc:
+            # perhaps evicted by another slave since the manifest was read
+            print >>stderr, 'WARNING: unable to fetch', name, exc
+            continue
+        room -= size
+        progress.update(size)
+        fetched[name] = used
+    if fetched:
+        # so that the store evicts what it fetched by when it was last used
+        with locked(join(store, LOCK_NAME)):
+            usage_path = join(store, USAGE_NAME)
+            usage = read_manifest(usage_path)
+            usage.update(fetched)
+            write_manifest(usage_path, usage)
+    if too_big:
+        print 'INFO: left %d objects used less recently in %s, for want of room in %s' % (
+            too_big, central, store)
+    write_manifest(state_path, {'time': started})
+    return len(fetched)
+
+def fetch():
+    directory, store = options.directory, options.store
+    make_directories(directory)
+    make_directories(store)
+    fetched = 0
+    if options.central:
+        fetched = fetch_central(options.central, store)
+    started = time()
+    linked = 0
+    objects = list_objects(store)
+    for name, st in objects.iteritems():
+        path = join(directory, name)
+        try:
+            here = lstat(path)
+        except OSError:
+            here = None
+        if here is None or here.st_ino != st.st_ino:
+            link_file(join(store, name), path)
+            linked += 1
+        # any read during the build moves the access time on from here,
+        # though a build running alongside on this slave may count the
+        # same read since the store and its builds share inodes
+        utime(path, (0, st.st_mtime))
+    # objects evicted from the store go from the build too, or the next
+    # publish would put them back
+    removed = 0
+    for name in list_objects(directory):
+        if name not in objects:
+            remove_file(join(directory, name))
+            removed += 1
+    write_manifest(join(directory, FETCH_NAME), {'time': started})
+    print 'INFO: linked %d of %d objects from %s, fetching %d centrally and removing %d' % (
+        linked, len(objects), store, fetched, removed)
+    statistic('sstate_available', len([n for n in objects if not n.endswith(SIGNATURE_SUFFIX)]))
+
+def evict(store, usage, max_bytes):
+    """Delete the least recently used objects from the store, or the
+    central directory, until it is under max_bytes, and return how many
+    went"""
+    objects = list_objects(store)
+    total = sum([st.st_size for st in objects.itervalues()])
+    if total <= max_bytes:
+        return 0
+    evicted = 0
+    order = sorted(objects.keys(), key=lambda name: usage.get(name, objects[name].st_mtime))
+    for name in order:
+        if total <= max_bytes * 0.9:
+            break
+        remove_file(join(store, name))
+        usage.pop(name, None)
+        total -= objects[name].st_size
+        evicted += 1
+    return evicted
+
+def publish():
+    directory, store = options.directory, options.store
+    started = read_manifest(join(directory, FETCH_NAME)).get('time')
+    now = time()
+    hits = misses = 0
+    new = []
+    used = [] # read by the build, so that other slaves' copies stay too
+    for name, st in list_objects(directory).iteritems():
+        counted = not name.endswith(SIGNATURE_SUFFIX)
+        try:
+            known = lstat(join(store, name)).st_ino == st.st_ino
+        except OSError:
+            known = False
+        if not known:
+            new.append(name)
+            if counted and (started is None or st.st_mtime >= started):
+                misses += 1
+        elif started is not None and st.st_atime >= started:
+            used.append(name)
+            if counted:
+                hits += 1
+
+    make_directories(store)
+    with locked(join(store, LOCK_NAME)):
+        usage_path = join(store, USAGE_NAME)
+        usage = read_manifest(usage_path)
+        for name in new:
+            dest = join(store, name)
+            make_directories(dirname(dest))
+            try:
+                link(join(directory, name), dest)
+            except OSError, exc:
+                if exc.errno == EXDEV:
+                    copy_file(join(directory, name), dest)
+                elif exc.errno != EEXIST:
+                    raise
+            usage[name] = now
+        for name in used:
+            usage[name] = now
+        evicted = evict(store, usage, options.max_size * 1024 ** 3)
+        write_manifest(usage_path, usage)
+
+    published = central_evicted = 0
+    if options.central:
+        progress = Progress('published')
+        for name in new:
+            dest = join(options.central, name)
+            if exists(dest):
+                continue
+            try:
+                copy_file(join(directory, name), dest)
+            except (IOError, OSError), exc:
+                print >>stderr, 'WARNING: unable to publish', name, exc
+                continue
+            progress.update(lstat(dest).st_size)
+            published += 1
+        with locked(join(options.central, LOCK_NAME)):
+            usage_path = join(options.central, USAGE_NAME)
+            usage = read_manifest(usage_path)
+            # stamped now rather than when publish started, see fetch_central
+            published_at = time()
+            for name in new + used:
+                usage[name] = published_at
+            central_evicted = evict(options.central, usage, options.central_max_size * 1024 ** 3)
+            write_manifest(usage_path, usage)
+
+    print 'INFO: stored %d new objects in %s, publishing %d centrally' % (
+        len(new), store, published)
+    statistic('sstate_hits', hits)
+    statistic('sstate_misses', misses)
+    statistic('sstate_evicted', evicted)
+    if options.central:
+        statistic('sstate_central_evicted', central_evicted)
+
+if __name__ == '__main__':
+    read_options()
+    t0 = time()
+    if command == 'fetch':
+        fetch()
+    else:
+        publish()
+    print 'TIMING: %s took %.1f seconds' % (command, time() - t0)
@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2014 Citrix Systems, Inc.
+# 
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Index of build tags named prefix, number, '-', branch, shared by
+do_tag.py and diff_tag.py"""
+
+from os import walk
+from os.path import join
+from bisect import bisect_left
+from hashlib import sha1
+from threading import Lock
+
+class TagIndex:
+    """The numbers of tags named prefix, number, '-', branch, kept
+    sorted for each branch and overall"""
+    def __init__(self, prefix, names=()):
+        self.prefix = prefix
+        self.names = set()
+        self.numbers = {} # { branch : tag numbers }
+        self.every = [] # tag numbers on any branch
+        self.tags = {} # { (number, branch) : tag name }
+        self.unsorted = False
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        """Take account of tag name"""
+        if name in self.names or not name.startswith(self.prefix):
+            return
+        self.names.add(name)
+        number, _, branch = name[len(self.prefix):].partition('-')
+        if not number.isdigit():
+            return
+        num = int(number)
+        if (num, branch) in self.tags:
+            return
+        self.tags[(num, branch)] = name
+        self.numbers.setdefault(branch, []).append(num)
+        self.every.append(num)
+        self.unsorted = True
+
+    def sorted_numbers(self, branch=None):
+        """Return the tag numbers on branch or on any branch in order"""
+        if self.unsorted:
+            for numbers in self.numbers.values():
+                numbers.sort()
+            self.every.sort()
+            self.unsorted = False
+        if branch:
+            return self.numbers.get(branch, [])
+        return self.every
+
+    def highest_number(self, branch=None):
+        """Return the highest tag number on branch or on any branch, 
+        or None if there are no tags"""
+        numbers = self.sorted_numbers(branch)
+        return numbers[-1] if numbers else None
+
+    def previous_number(self, number, branch=None):
+        """Return the highest tag number below number on branch or on
+        any branch, or None if there is none"""
+        numbers = self.sorted_numbers(branch)
+        i = bisect_left(numbers, number)
+        return numbers[i-1] if i else None
+
+    def tag(self, number, branch):
+        """Return the name of the tag number on branch, or None"""
+        return self.tags.get((number, branch))
+
+def list_tags_command(repod, prefix, git='git'):
+    """Return the command listing the tags in repod, for parse_tag_list.
+    All the tags are listed since a for-each-ref pattern ending in * does
+    not match across /, which would miss branches named like foo/bar."""
+    return [git, '--git-dir='+repod, 'for-each-ref', '--format=%(refname)',
+            'refs/tags/']
+
+def parse_tag_list(out, prefix):
+    """Return the names of the tags starting with prefix in the output of
+    list_tags_command"""
+    tags = [ref[len('refs/tags/'):] for ref in out.split()]
+    return [tag for tag in tags if tag.startswith(prefix)]
+
+shared_indices = {} # { (prefix, digest of tag list) : TagIndex }
+shared_indices_lock = Lock()
+
+def shared_index(prefix, out):
+    """Return a TagIndex for the output of list_tags_command, shared
+    with every other repository which has the same tags. The index
+    must not be added to."""
+    # for-each-ref sorts by name, so the same tags give the same output
+    key = (prefix, sha1(out).hexdigest())
+    shared_indices_lock.acquire()
+    try:
+        if key not in shared_indices:
+            index = TagIndex(prefix, parse_tag_list(out, prefix))
+            # sort now so that later lookups from other threads only read
+            index.sorted_numbers()
+            shared_indices[key] = index
+        return shared_indices[key]
+    finally:
+        shared_indices_lock.release()
+
+def read_packed_tags(repod):
+    """Return the names of the tags in the packed-refs file of repod"""
+    names = []
+    for line in file(repod+'/packed-refs', 'r'):
+        # lines are "SHA REF", or "^SHA" for the peeled value of the 
+        # previous line, or a "#" comment
+        spl = line.split()
+        if len(spl) == 2 and spl[1].startswith('refs/tags/'):
+            names.append(spl[1][len('refs/tags/'):])
+    return names
+
+def list_loose_tags(repod):
+    """Return the names of the tags stored as files in repod"""
+    base = repod+'/refs/tags'
+    names = []
+    for dirpath, _, filenames in walk(base):
+        for filename in filenames:
+            if not filename.endswith('.lock'):
+                names.append(join(dirpath, filename)[len(base)+1:])
+    return names